@@ -0,0 +1,53 @@
+"""Full vs reduced-resolution decode of a 24 MP JPEG for the autocrop path.
+
+Run from the repository root: python -m benchmarks.decode
+"""
+import io
+import time
+import numpy as np
+import PIL.Image as Image
+from photobot.photo_task import open_for_frame, real_frame_size
+
+REPEAT = 5
+
+def make_jpeg(width=6000, height=4000) -> bytes:
+    yy, xx = np.mgrid[0:height, 0:width]
+    noise = np.random.default_rng(0).integers(0, 32, (height, width), dtype=np.uint8)
+    arr = np.dstack([xx * 255 // width, yy * 255 // height, (xx // 7 + yy // 5) % 256]).astype(np.uint8)
+    arr[..., 2] += noise
+    buf = io.BytesIO()
+    Image.fromarray(arr).save(buf, "JPEG", quality=92)
+    return buf.getvalue()
+
+def full_decode(data: bytes) -> Image.Image:
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    return img
+
+def reduced_decode(data: bytes) -> Image.Image:
+    return open_for_frame(io.BytesIO(data), real_frame_size)
+
+def autocrop(img: Image.Image) -> Image.Image:
+    side = min(img.size)
+    left, top = (img.width - side) // 2, (img.height - side) // 2
+    return img.resize((real_frame_size, real_frame_size), resample=Image.LANCZOS, box=(left, top, left + side, top + side))
+
+def measure(name, decode, data):
+    best_decode = best_total = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        img = decode(data)
+        decoded = time.perf_counter()
+        autocrop(img)
+        done = time.perf_counter()
+        best_decode = min(best_decode, decoded - start)
+        best_total = min(best_total, done - start)
+    memory = img.width * img.height * len(img.getbands())
+    print(f"{name:8} {img.size[0]:5}x{img.size[1]:<5} decode {best_decode*1000:7.1f} ms  "
+          f"decode+crop {best_total*1000:7.1f} ms  pixels {memory/2**20:6.1f} MiB")
+
+if __name__ == "__main__":
+    data = make_jpeg()
+    print(f"24 MP JPEG, {len(data)/2**20:.1f} MiB, best of {REPEAT}")
+    measure("full", full_decode, data)
+    measure("reduced", reduced_decode, data)
@@ -0,0 +1,64 @@
+"""Compare the final image encoder profiles on avatars rendered with the real layer stack.
+
+For every profile and input this reports the encode time (best of
+--repeat), the output size and the PSNR against the unencoded avatar.
+Profiles come from photo.encoder_profiles of --config, or the defaults.
+
+    python -m benchmarks.encoders
+    python -m benchmarks.encoders --config config/config.yaml --inputs portrait-12mp-jpeg
+"""
+import argparse
+import math
+import os
+import sys
+import numpy as np
+import yaml
+import PIL.Image as Image
+from photobot.config import PhotoSettings
+from photobot.photo_task import real_frame_size, final_frame_size, autocrop_job, finalize_job, encoder_args, ENCODER_FORMATS, _init_worker
+from photobot.pipeline import ENGINE_FUSED
+from benchmarks.suite import input_file, LAYERS, CACHE
+
+DEFAULT_INPUTS = ("landscape-1mp-jpeg", "portrait-12mp-jpeg", "landscape-12mp-alpha")
+
+# lossless reference the profiles are compared to
+REFERENCE = {"format": "BMP"}
+
+def psnr(reference: np.ndarray, file: str) -> float:
+    with Image.open(file) as img:
+        decoded = np.asarray(img.convert("RGB"), dtype=np.float64)
+    mse = np.mean((reference - decoded) ** 2)
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--config", help="YAML config to take photo.encoder_profiles from")
+    parser.add_argument("--inputs", nargs="+", default=list(DEFAULT_INPUTS))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    if args.config:
+        with open(args.config) as f:
+            settings = PhotoSettings(**yaml.safe_load(f)["photo"])
+    else:
+        settings = PhotoSettings()
+    profiles = {name: encoder_args(profile) for name, profile in settings.encoder_profiles.items()}
+    _init_worker(LAYERS, [real_frame_size, final_frame_size], ENGINE_FUSED)
+    os.makedirs(CACHE, exist_ok=True)
+
+    print(f"{'profile':12} {'input':22} {'encode ms':>10} {'KiB':>8} {'PSNR dB':>8}")
+    for spec in args.inputs:
+        cropped, _ = autocrop_job(input_file(spec))
+        reference_file = os.path.join(CACHE, "reference.bmp")
+        finalize_job(cropped, reference_file, REFERENCE)
+        with Image.open(reference_file) as img:
+            reference = np.asarray(img.convert("RGB"), dtype=np.float64)
+        for name, encoder in profiles.items():
+            fn = os.path.join(CACHE, f"encoded.{ENCODER_FORMATS[encoder['format']]}")
+            encode = min(finalize_job(cropped, fn, encoder)["encode"] for _ in range(args.repeat))
+            size = os.path.getsize(fn)
+            print(f"{name:12} {spec:22} {encode * 1000:10.1f} {size / 1024:8.1f} {psnr(reference, fn):8.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""Compare the single-resampling autocrop render plan with the two-pass one it replaced.
+
+two-pass: crop and scale to real_frame_size, composite, scale to final_frame_size
+direct:   crop and scale straight to final_frame_size, composite with layers flattened at that size
+
+Both are timed end to end (best of --repeat) and compared, as 8 bit RGB
+before encoding, against a supersampled reference: the full decode
+scaled to 2x the final size, composited there and scaled down once.
+
+    python -m benchmarks.render_plan
+"""
+import argparse
+import math
+import os
+import sys
+import time
+import numpy as np
+import PIL.Image as Image
+from photobot.photo_task import real_frame_size, final_frame_size, autocrop_job, autocrop_box, finalize_job, _init_worker
+from photobot.frame_asset import FrameAsset
+from photobot.pipeline import render_stack, ENGINE_FUSED
+from benchmarks.suite import input_file, LAYERS, CACHE, DEFAULT_INPUTS
+
+LOSSLESS = {"format": "BMP"}
+
+def render(file: str, size: int) -> tuple[np.ndarray, float]:
+    fn = os.path.join(CACHE, f"plan_{size}.bmp")
+    start = time.perf_counter()
+    cropped, _ = autocrop_job(file, size)
+    finalize_job(cropped, fn, LOSSLESS)
+    elapsed = time.perf_counter() - start
+    with Image.open(fn) as img:
+        return np.asarray(img.convert("RGB"), dtype=np.float64), elapsed
+
+def reference(file: str, stack: FrameAsset) -> np.ndarray:
+    size = 2 * final_frame_size
+    with Image.open(file) as img:
+        cropped = img.resize((size, size), resample=Image.LANCZOS, box=autocrop_box(*img.size))
+    composition = render_stack(cropped, stack.get(size)).convert("RGB")
+    final = composition.resize((final_frame_size, final_frame_size), resample=Image.LANCZOS)
+    return np.asarray(final, dtype=np.float64)
+
+def psnr(a: np.ndarray, b: np.ndarray) -> float:
+    mse = np.mean((a - b) ** 2)
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--inputs", nargs="+", default=list(DEFAULT_INPUTS))
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    _init_worker(LAYERS, [real_frame_size, final_frame_size], ENGINE_FUSED)
+    reference_stack = FrameAsset(LAYERS, [2 * final_frame_size])
+    os.makedirs(CACHE, exist_ok=True)
+    pixels = {"two-pass": real_frame_size ** 2, "direct": final_frame_size ** 2}
+    print(f"pixels composited per avatar: two-pass {pixels['two-pass']}, direct {pixels['direct']} "
+          f"({1 - pixels['direct'] / pixels['two-pass']:.0%} less)")
+
+    print(f"{'input':22} {'plan':9} {'ms':>8} {'PSNR ref':>9} {'max diff':>9}")
+    for spec in args.inputs:
+        file = input_file(spec)
+        ideal = reference(file, reference_stack)
+        outputs = dict()
+        for plan, size in (("two-pass", real_frame_size), ("direct", final_frame_size)):
+            render(file, size)  # warm up
+            best = float("inf")
+            for _ in range(args.repeat):
+                out, elapsed = render(file, size)
+                best = min(best, elapsed)
+            outputs[plan] = out
+            print(f"{spec:22} {plan:9} {best * 1000:8.1f} {psnr(ideal, out):9.2f} {np.abs(ideal - out).max():9.0f}")
+        print(f"{spec:22} {'two-pass vs direct':>18} PSNR {psnr(outputs['two-pass'], outputs['direct']):.2f} dB")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,246 @@
+"""Benchmarks of the image hot paths on synthetic inputs, with JSON baselines.
+
+Every stage runs on every input, in isolation and end to end, and reports
+wall time and CPU time (best of --repeat) and the peak RSS reached while
+it ran. Inputs are generated once and cached in the temp directory, the
+layers are the real layers/stack.yaml, nothing touches the network.
+
+Run from the repository root:
+
+    python -m benchmarks.suite --save benchmarks/baseline.json
+    python -m benchmarks.suite --compare benchmarks/baseline.json --threshold 0.2
+
+The exit status is 1 when the fused pipeline differs from render_stack
+by more than FUSED_TOLERANCE on any input, or, with --compare, when any
+stage is slower than the baseline by more than the threshold. Baselines are only comparable on
+the machine that recorded them.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import PIL
+import PIL.Image as Image
+from photobot import photo_task
+from photobot.photo_task import (
+    real_frame_size, final_frame_size, img_transform, transform_job, autocrop_job, finalize_job,
+    open_for_frame, _init_worker,
+)
+from photobot.pipeline import render_stack, fused_pipeline, ENGINE_FUSED, ENGINE_PIL
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYERS = os.path.join(ROOT, "layers", "stack.yaml")
+CACHE = os.path.join(tempfile.gettempdir(), "photobot-benchmarks")
+
+# orientation-megapixels-format
+DEFAULT_INPUTS = (
+    "landscape-1mp-jpeg", "portrait-1mp-png", "landscape-1mp-alpha",
+    "portrait-12mp-jpeg", "landscape-12mp-alpha",
+    "landscape-24mp-jpeg", "portrait-24mp-png",
+)
+FULL_INPUTS = DEFAULT_INPUTS + ("portrait-48mp-jpeg", "landscape-48mp-png", "landscape-48mp-alpha")
+FORMATS = {"jpeg": ("JPEG", "jpg"), "png": ("PNG", "png"), "alpha": ("PNG", "png")}
+
+# stages slower than the baseline by less than this are noise, whatever the ratio
+MIN_REGRESSION_MS = 2.0
+# levels per channel fused_pipeline may differ from render_stack by, see its docstring
+FUSED_TOLERANCE = 1
+
+def input_file(spec: str) -> str:
+    orientation, megapixels, fmt = spec.split("-")
+    pixels = float(megapixels.rstrip("mp")) * 1e6
+    # 4:3 photos
+    long_side, short_side = round(math.sqrt(pixels * 4 / 3)), round(math.sqrt(pixels * 3 / 4))
+    width, height = (long_side, short_side) if orientation == "landscape" else (short_side, long_side)
+    pil_format, ext = FORMATS[fmt]
+    fn = os.path.join(CACHE, f"{spec}.{ext}")
+    if os.path.exists(fn):
+        return fn
+    os.makedirs(CACHE, exist_ok=True)
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    rng = np.random.default_rng(0)
+    # smooth gradients plus texture, so that compression behaves like on a photo
+    arr = np.dstack([
+        xx * 255 / width,
+        yy * 255 / height,
+        127.5 + 127.5 * np.sin(xx / 37) * np.cos(yy / 53),
+    ]) + rng.normal(0, 6, (height, width, 3))
+    arr = np.clip(arr, 0, 255).astype(np.uint8)
+    if fmt == "alpha":
+        # opaque centre fading to transparent corners
+        r = np.hypot((xx - width / 2) / width, (yy - height / 2) / height)
+        alpha = np.clip((0.7 - r) * 4 * 255, 0, 255).astype(np.uint8)
+        img = Image.fromarray(np.dstack([arr, alpha]), "RGBA")
+    else:
+        img = Image.fromarray(arr, "RGB")
+    tmp = fn + ".part"
+    img.save(tmp, pil_format, quality=92)
+    os.replace(tmp, fn)
+    return fn
+
+def fit_matrix(file: str) -> tuple:
+    """A typical web app transform: fit the short side, turn 5 degrees, nudge off centre."""
+    with Image.open(file) as img:
+        scale = real_frame_size / min(img.size) * 1.1
+    angle = math.radians(5)
+    a, b = scale * math.cos(angle), scale * math.sin(angle)
+    c, d = -b, a
+    return (a, b, c, d, 40.0, -25.0)
+
+def _decode(file):
+    img = open_for_frame(file)
+    img.load()
+    return img
+
+def _crop(file):
+    cropped, _ = transform_job(file, *fit_matrix(file))
+    return cropped
+
+def _final_file():
+    return os.path.join(CACHE, "final.jpg")
+
+def _finalize(engine):
+    def run(cropped):
+        photo_task.pipeline_engine = engine
+        finalize_job(cropped, _final_file())
+    return run
+
+def _end_to_end(crop):
+    def run(file):
+        photo_task.pipeline_engine = ENGINE_FUSED
+        cropped, _ = crop(file)
+        finalize_job(cropped, _final_file())
+    return run
+
+# name -> (setup(file) -> argument, run(argument))
+STAGES = {
+    "decode": (lambda file: file, _decode),
+    "legacy_transform": (
+        lambda file: (Image.open(file).convert("RGBA"), fit_matrix(file)),
+        lambda arg: img_transform(arg[0], *arg[1]),
+    ),
+    "transform": (lambda file: file, lambda file: transform_job(file, *fit_matrix(file))),
+    "autocrop": (lambda file: file, autocrop_job),
+    "pipeline_pil": (_crop, lambda cropped: render_stack(cropped, photo_task.frame_asset.get(final_frame_size)).convert("RGB")),
+    "pipeline_fused": (_crop, lambda cropped: fused_pipeline(cropped, photo_task.frame_asset.planes(final_frame_size))),
+    "finalize_pil": (_crop, _finalize(ENGINE_PIL)),
+    "finalize_fused": (_crop, _finalize(ENGINE_FUSED)),
+    "e2e_autocrop": (lambda file: file, _end_to_end(autocrop_job)),
+    "e2e_transform": (lambda file: file, _end_to_end(lambda file: transform_job(file, *fit_matrix(file)))),
+}
+
+def fused_difference(file: str) -> int:
+    """Largest per-channel difference between the fused kernel and render_stack on the crop of `file`."""
+    cropped = _crop(file)
+    stack = photo_task.frame_asset.get(final_frame_size)
+    reference = np.asarray(render_stack(cropped, stack).convert("RGB"), dtype=np.int16)
+    fused = np.asarray(fused_pipeline(cropped, photo_task.frame_asset.planes(final_frame_size), stack.contrast), dtype=np.int16)
+    return int(np.abs(reference - fused).max())
+
+def _reset_peak_rss() -> bool:
+    # Linux resets VmHWM to the current RSS on this write
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # process lifetime peak, kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024
+
+def measure(stage: str, file: str, repeat: int) -> dict:
+    setup, run = STAGES[stage]
+    arg = setup(file)
+    run(arg)  # warm up caches and lazy imports
+    wall = cpu = float("inf")
+    _reset_peak_rss()
+    for _ in range(repeat):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        run(arg)
+        wall = min(wall, time.perf_counter() - wall_start)
+        cpu = min(cpu, time.process_time() - cpu_start)
+    return {"wall_ms": round(wall * 1000, 2), "cpu_ms": round(cpu * 1000, 2), "peak_rss_mb": round(_peak_rss_mb(), 1)}
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            continue
+        limit = base["wall_ms"] * (1 + threshold)
+        if result["wall_ms"] > limit and result["wall_ms"] - base["wall_ms"] > MIN_REGRESSION_MS:
+            regressions.append(f"{key}: {result['wall_ms']:.1f} ms, baseline {base['wall_ms']:.1f} ms (+{threshold:.0%} allowed)")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--inputs", nargs="+", help=f"input specs, default {' '.join(DEFAULT_INPUTS)}")
+    parser.add_argument("--full", action="store_true", help="include the 48 MP inputs")
+    parser.add_argument("--stages", nargs="+", choices=sorted(STAGES), default=list(STAGES))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", help="write results to this JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to check against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+
+    inputs = args.inputs or (FULL_INPUTS if args.full else DEFAULT_INPUTS)
+    _init_worker(LAYERS, [real_frame_size, final_frame_size], ENGINE_FUSED)
+
+    results = dict()
+    mismatches = []
+    print(f"{'stage':18} {'input':22} {'wall ms':>9} {'cpu ms':>9} {'peak MiB':>9}")
+    for spec in inputs:
+        file = input_file(spec)
+        difference = fused_difference(file)
+        if difference > FUSED_TOLERANCE:
+            mismatches.append(f"{spec}: fused_pipeline differs from render_stack by {difference} levels, {FUSED_TOLERANCE} allowed")
+        for stage in args.stages:
+            result = measure(stage, file, args.repeat)
+            results[f"{stage}/{spec}"] = result
+            print(f"{stage:18} {spec:22} {result['wall_ms']:9.1f} {result['cpu_ms']:9.1f} {result['peak_rss_mb']:9.1f}")
+
+    if args.save:
+        meta = {
+            "python": platform.python_version(),
+            "pillow": PIL.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+        }
+        with open(args.save, "w") as f:
+            json.dump({"meta": meta, "results": results}, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {args.save}")
+
+    for line in mismatches:
+        print(f"MISMATCH {line}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        if regressions:
+            return 1
+        print(f"no stage slower than {args.compare} by more than {args.threshold:.0%}")
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
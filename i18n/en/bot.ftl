@@ -6,6 +6,9 @@ autocrop-command = Automatic
 select-position-command = Select position
 select-position-prompt = Photo received. Now select how it will be placed in the frame.
 processing-photo = Photo is processing... (it may take some time)
+processing-queued = ⏳ Many photos are being processed right now, yours is number { $position } in the queue.
+processing-busy = 😔 Too many photos are being processed right now. Please send your picture again in a few minutes.
+processing-in-progress = ⏳ Your previous photo is still being processed, please wait a little.
 cover-caption-message =
     ❗️If you use this photo in the social networks with profile covers, it goes well with this one.
 final-message =
@@ -6,6 +6,9 @@ autocrop-command = Так сойдёт
 select-position-command = Выбрать расположение
 select-position-prompt = Фото загружено. Расположите фото как Вам больше нравится.
 processing-photo = Аватар обрабатывается. Это может занять какое-то время.
+processing-queued = ⏳ Сейчас обрабатывается много фотографий, Ваша — { $position }-я в очереди.
+processing-busy = 😔 Сейчас обрабатывается слишком много фотографий. Пожалуйста, пришлите фото ещё раз через несколько минут.
+processing-in-progress = ⏳ Предыдущее фото ещё обрабатывается, подождите немного, пожалуйста.
 cover-caption-message =
     ❗️Получившуюся аватарку рекомендуется загружать в личный профиль Вконтакте вместе со специальной обложкой профиля.
 final-message =
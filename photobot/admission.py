@@ -0,0 +1,112 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# lower runs first: finishing a conversation beats starting a crop, both beat previews
+PRIORITY_FINALIZE = 0
+PRIORITY_CROP = 1
+PRIORITY_PREVIEW = 2
+
+class AdmissionError(Exception):
+    pass
+
+class QueueFull(AdmissionError):
+    """The wait queue is at its limit."""
+
+class UserBusy(AdmissionError):
+    """The user already has a job queued or running."""
+
+class AdmissionController(object):
+    """Bounded priority queue in front of the ImageExecutor.
+
+    At most `slots` jobs are handed to the executor at a time, so its own
+    queue stays empty and the order is decided here. Up to `max_queue`
+    jobs wait, further ones raise QueueFull. Jobs carrying a user id are
+    limited to `user_jobs` in flight per user. `on_queued(position)` is
+    awaited when a job has to wait, position 1 being the next to run.
+    Only touched from the event loop.
+    """
+    def __init__(self, executor, slots: int, max_queue: int, user_jobs: int = 1):
+        self.executor = executor
+        self.slots = slots
+        self.max_queue = max_queue
+        self.user_jobs = user_jobs
+        self.running = 0
+        self.queue = []
+        self.users = dict()
+        self._order = itertools.count()
+        # observability
+        self.admitted = 0
+        self.rejected = 0
+
+    def depth(self) -> int:
+        return len(self.queue)
+
+    def position(self, entry: list) -> int:
+        return sum(1 for other in self.queue if other[:2] <= entry[:2])
+
+    async def run(self, func, *args, priority: int = PRIORITY_CROP, user_id: int|None = None, on_queued=None, **kwargs):
+        if user_id is not None and self.users.get(user_id, 0) >= self.user_jobs:
+            self.rejected += 1
+            raise UserBusy(f"user {user_id} already has {self.user_jobs} jobs in flight")
+        if self.running >= self.slots and len(self.queue) >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(f"{len(self.queue)} jobs waiting")
+        if user_id is not None:
+            self.users[user_id] = self.users.get(user_id, 0) + 1
+        self.admitted += 1
+        try:
+            await self._acquire(priority, on_queued)
+            try:
+                return await self.executor.run(func, *args, **kwargs)
+            finally:
+                self._release()
+        finally:
+            if user_id is not None:
+                self.users[user_id] -= 1
+                if self.users[user_id] == 0:
+                    del self.users[user_id]
+
+    async def _acquire(self, priority: int, on_queued):
+        if self.running < self.slots and not self.queue:
+            self.running += 1
+            metrics.stages.observe("queue_wait", 0.0)
+            return
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._order), future]
+        heapq.heappush(self.queue, entry)
+        try:
+            if on_queued is not None:
+                try:
+                    await on_queued(self.position(entry))
+                except Exception as e:
+                    logger.error(f"queue notification failed: {e}", exc_info=1)
+            await future
+        except BaseException:
+            if future.done() and not future.cancelled():
+                # the slot was handed over just as we gave up
+                self._release()
+            else:
+                future.cancel()
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+            raise
+        waited = time.perf_counter() - start
+        metrics.stages.observe("queue_wait", waited)
+        if waited > 1:
+            logger.info(f"image job waited {waited:.1f} s in the admission queue, {len(self.queue)} still waiting")
+
+    def _release(self):
+        self.running -= 1
+        while self.queue and self.running < self.slots:
+            _, _, future = heapq.heappop(self.queue)
+            if future.done():
+                continue
+            self.running += 1
+            future.set_result(None)
@@ -1,44 +1,121 @@
-import functools
-from typing import Any, Dict, List
+import glob
+import os
+from typing import Any, Dict, List, Tuple
 from fluent.runtime import FluentLocalization, FluentResourceLoader
+from fluent.runtime.fallback import AbstractResourceLoader
+from fluent.syntax import ast
 import logging
 
 logger = logging.getLogger(__name__)
 
+# messages named like this are button labels, resolved back by Localization.command()
+COMMAND_SUFFIX = "-command"
+
 def locale_unify(locale: str) -> str:
     return locale.lower().replace("_", "-")
 
+def label_unify(label: str) -> str:
+    return " ".join(label.split()).casefold()
+
+class CachedResourceLoader(AbstractResourceLoader):
+    """Parses every resource once, all locale chains share the result."""
+    def __init__(self, loader: FluentResourceLoader):
+        self.loader = loader
+        self.roots = loader.roots
+        self.cache: Dict[Tuple[str, Tuple[str, ...]], List[List[ast.Resource]]] = dict()
+
+    def resources(self, locale: str, resource_ids: List[str]):
+        key = (locale, tuple(resource_ids))
+        if key not in self.cache:
+            self.cache[key] = list(self.loader.resources(locale, resource_ids))
+        return iter(self.cache[key])
+
 class Localization:
+    """Fluent catalog with every locale found under the loader roots parsed up front.
+
+    Localizations are kept per locale chain, messages without arguments are
+    memoized, and button labels of all locales map back to their message id.
+    """
     def __init__(
             self,
             loader: FluentResourceLoader,
             base:str = "translations.ftl",
             fallbacks: List[str] = ["en_US", "en"],
         ):
-        self.loader = loader
+        self.loader = CachedResourceLoader(loader)
         self.fallbacks = [locale_unify(fb) for fb in fallbacks]
         self.base = base
+        self.localizations: Dict[Tuple[str, ...], FluentLocalization] = dict()
+        self.messages: Dict[Tuple[Tuple[str, ...], str], str] = dict()
+        self.commands: Dict[str, str] = dict()
         logger.debug(f"Creating localization from {self.base} and fallbacks {self.fallbacks}")
+        self.locales = self.find_locales()
+        for locale in self.locales:
+            self.index_commands(locale)
+        logger.info(f"loaded locales {self.locales}, {len(self.commands)} command labels")
+
+    def find_locales(self) -> List[str]:
+        locales = []
+        for root in self.loader.roots:
+            if "{locale}" not in root:
+                continue
+            prefix, suffix = root.split("{locale}", maxsplit=1)
+            for path in sorted(glob.glob(glob.escape(prefix) + "*" + glob.escape(suffix))):
+                if not os.path.isfile(os.path.join(path, self.base)):
+                    continue
+                locale = locale_unify(path[len(prefix):len(path) - len(suffix)])
+                if locale not in locales:
+                    locales.append(locale)
+        return locales
+
+    def index_commands(self, locale: str):
+        localization = self.get_locale(locale)
+        for resources in self.loader.resources(locale, [self.base]):
+            for resource in resources:
+                for entry in resource.body:
+                    if not isinstance(entry, ast.Message) or not entry.id.name.endswith(COMMAND_SUFFIX):
+                        continue
+                    label = label_unify(localization.format_value(entry.id.name))
+                    known = self.commands.setdefault(label, entry.id.name)
+                    if known != entry.id.name:
+                        logger.warning(f"label {label!r} of {entry.id.name} in {locale} is already used by {known}")
+
+    def command(self, text: str) -> str|None:
+        """Message id of the button label `text` in any locale."""
+        return self.commands.get(label_unify(text))
 
     def locale_to_list(self, locale: str) -> List[str]:
         split = locale.split("-", maxsplit=1)
-        if len(split) > 0:
+        if len(split) > 1:
             return [locale, split[0]]
         return [locale]
 
-    @functools.cache
-    def get_locale(self, locale: List[str]|str|None = None):
-        logger.debug(f"Loading locale {locale}")
-        locales = self.fallbacks
-        if locale is not None:
-            if isinstance(locale, str):
-                locale = self.locale_to_list(locale)
-            if isinstance(locale, List):
-                locales = [locale_unify(l) for l in locale]
-                locales.extend(self.fallbacks)
-        return FluentLocalization(locales, [self.base], self.loader)
+    def locale_chain(self, locale: List[str]|str|None = None) -> Tuple[str, ...]:
+        locales = []
+        if isinstance(locale, str):
+            locales = self.locale_to_list(locale_unify(locale))
+        elif locale is not None:
+            locales = [locale_unify(l) for l in locale]
+        chain = []
+        for l in locales + self.fallbacks:
+            if l not in chain:
+                chain.append(l)
+        return tuple(chain)
+
+    def get_locale(self, locale: List[str]|str|None = None) -> FluentLocalization:
+        chain = self.locale_chain(locale)
+        if chain not in self.localizations:
+            logger.debug(f"Loading locale {chain}")
+            self.localizations[chain] = FluentLocalization(list(chain), [self.base], self.loader)
+        return self.localizations[chain]
 
     def __call__(self, key, args: Dict[str, Any]|None = None, locale: List[str]|str|None = None):
-        ret = self.get_locale(locale).format_value(key, args)
+        if args:
+            ret = self.get_locale(locale).format_value(key, args)
+        else:
+            memo_key = (self.locale_chain(locale), key)
+            ret = self.messages.get(memo_key)
+            if ret is None:
+                ret = self.messages[memo_key] = self.get_locale(locale).format_value(key)
         logger.debug(f"translating {key} with args {args} and locale {locale}, result: {ret}")
         return ret
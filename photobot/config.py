@@ -1,10 +1,25 @@
+import hashlib
 import yaml
 
-from pydantic import BaseSettings, Field, SecretStr 
+from pydantic import BaseModel, BaseSettings, Field, SecretStr 
 from datetime import timedelta
 
+TELEGRAM_POLLING = "polling"
+TELEGRAM_WEBHOOK = "webhook"
+
 class TelegramSettings(BaseSettings):
     token: SecretStr = Field(env="TELEGRAM_TOKEN")
+    mode: str = Field(TELEGRAM_POLLING, env="TELEGRAM_MODE") # polling|webhook
+    webhook_path: str = Field("/telegram") # route on our server, published as server.base + webhook_path
+    webhook_secret: SecretStr|None = Field(None, env="TELEGRAM_WEBHOOK_SECRET") # derived from the token when empty
+    webhook_register: bool = Field(True) # call setWebhook at startup, off for local replays
+    webhook_max_connections: int = Field(40)
+
+    def webhook_secret_token(self) -> str:
+        if self.webhook_secret is not None and self.webhook_secret.get_secret_value():
+            return self.webhook_secret.get_secret_value()
+        # the same on every instance, and nothing that leaks the token
+        return hashlib.sha256(b"webhook:" + self.token.get_secret_value().encode()).hexdigest()
 
 class LoggingSettings(BaseSettings):
     level: str = Field("WARNING", env="LOGGING_LEVEL")
@@ -12,14 +27,60 @@ class LoggingSettings(BaseSettings):
 class ServerSettings(BaseSettings):
     base: str
     port: int = Field(8080, env="SERVER_PORT")
+    max_upload_size: int = Field(16*1024*1024) # bytes, web app upload request body
+    metrics: bool = Field(False) # serve /metrics in the Prometheus text format, on the public port
+    assets_path: str = Field("assets") # fingerprinted web app files, built from static/ at startup
+    frame_sizes: list[int] = Field([480, 960, 1440]) # px, web app frame renditions for 1x, 2x and 3x screens
+
+class EncoderProfile(BaseModel):
+    """Writer settings of the final image, see the JPEG and WebP writers of PIL."""
+    format: str = "JPEG" # JPEG|WEBP
+    quality: int = 90
+    optimize: bool = True # JPEG, extra pass computing optimal Huffman tables
+    progressive: bool = False # JPEG
+    subsampling: str = "4:2:0" # JPEG chroma subsampling, 4:4:4|4:2:2|4:2:0
+    method: int = 4 # WEBP, 0 (fast) to 6 (small)
 
 class PhotoSettings(BaseSettings):
     cpu_threads: int = Field(8)
+    executor: str = Field("thread") # thread|process
+    max_queue: int = Field(64) # image jobs waiting for a worker, more are turned away
+    pipeline_engine: str = Field("fused") # fused|pil
+    web_app_submission: str = Field("matrix") # matrix|upload
+    upload_formats: list[str] = Field(["webp", "png"]) # upload submission formats by preference: webp, webp-lossless, jpeg, png
+    upload_quality: float = Field(0.95) # canvas encoder quality of the lossy upload formats, 0..1
     storage_path: str = Field("photos")
+    task_store: str = Field("memory") # memory|sqlite, single process either way
+    task_db: str = Field("tasks.sqlite3") # relative to storage_path
+    conversations_file: str = Field("conversations.pickle") # relative to storage_path, kept with a persistent task store
+    crop_memory_budget: int = Field(256*1024*1024) # bytes of cropped stages kept in memory
+    photo_size_margin: float = Field(1.25) # short side of the received photo to pick, in working frames
+    download_memory_limit: int = Field(2*1024*1024) # bytes, smaller photos are downloaded into memory
+    cache_size: int = Field(1024*1024*1024) # bytes of photos and avatars cached by telegram file id, 0 disables
+    cache_path: str = Field("cache") # relative to storage_path
     cover_path: str|None = Field(None)
+    layers_file: str = Field("layers/stack.yaml") # layer stack around the photo, re-read when it changes
+    encoder_profiles: dict[str, EncoderProfile] = Field({
+        "default": EncoderProfile(),
+        "fast": EncoderProfile(quality=88, optimize=False),
+    })
+    encoder_profile: str = Field("default") # profile of the final image
+    fast_encoder_profile: str|None = Field("fast") # profile used while the image queue is deep, None to always use encoder_profile
+    fast_encoder_queue: int = Field(4) # image jobs waiting for admission that switch to fast_encoder_profile
     conversation_timeout: timedelta = Field(timedelta(hours=2))
     admins: list[int] = []
 
+class LayerSettings(BaseModel):
+    """One layer of the stack in photo.layers_file, either the user photo or an image file."""
+    photo: bool = False
+    file: str|None = None # square image, relative to the working directory
+    blend: str = "normal" # normal|multiply|screen|overlay|darken|lighten
+    opacity: float = 1.0
+    filters: list[dict[str, float]] = [] # applied in order, e.g. [{contrast: 1.1}], contrast|brightness|color|sharpness
+
+class LayerStackSettings(BaseModel):
+    layers: list[LayerSettings] # bottom to top
+
 class LocalizationSettings(BaseSettings):
     path: str = Field("i18n/{locale}", env="LOCALIZATION_PATH")
     fallbacks: list[str] = Field(["en-US", "en"])
@@ -28,6 +89,9 @@ class LocalizationSettings(BaseSettings):
 class UsersDB(BaseSettings):
     address: str = Field("", env="BOT_MONGODB_ADDRESS")
     collection: str = Field("bot_users", env="BOT_MONGODB_COLLECTION")
+    flush_size: int = Field(500) # queued users that trigger a bulk write
+    flush_interval: float = Field(5.0) # seconds between bulk writes
+    max_pending: int = Field(10000) # queued users, updates for more are dropped
 
 class Config(BaseSettings):
     telegram: TelegramSettings
@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
+import PIL.Image as Image
+
+logger = logging.getLogger(__name__)
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+class SharedImage(object):
+    """Picklable handle to image pixels placed in a shared memory block.
+
+    Only the block name travels through the pool's pipe. The receiving side
+    owns the block and releases it in `to_image`.
+    """
+    __slots__ = ("name", "mode", "size", "length")
+
+    def __init__(self, img: Image.Image):
+        data = img.tobytes()
+        self.mode = img.mode
+        self.size = img.size
+        self.length = len(data)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, self.length))
+        try:
+            shm.buf[:self.length] = data
+            self.name = shm.name
+        except Exception:
+            shm.close()
+            shm.unlink()
+            raise
+        shm.close()
+
+    def __getstate__(self):
+        return (self.name, self.mode, self.size, self.length)
+
+    def __setstate__(self, state):
+        self.name, self.mode, self.size, self.length = state
+
+    def to_image(self) -> Image.Image:
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            with shm.buf[:self.length] as view:
+                return Image.frombytes(self.mode, self.size, view)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def release(self):
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+def _export(value):
+    if isinstance(value, Image.Image):
+        return SharedImage(value)
+    if isinstance(value, tuple):
+        return tuple(_export(v) for v in value)
+    return value
+
+def _import(value):
+    if isinstance(value, SharedImage):
+        return value.to_image()
+    if isinstance(value, tuple):
+        return tuple(_import(v) for v in value)
+    return value
+
+def _release(value):
+    if isinstance(value, SharedImage):
+        value.release()
+    elif isinstance(value, tuple):
+        for v in value:
+            _release(v)
+
+def _run_in_worker(func, args, kwargs):
+    args = [_import(a) for a in args]
+    return _export(func(*args, **kwargs))
+
+def _warm_up():
+    return multiprocessing.current_process().name
+
+class ImageExecutor(object):
+    """Runs image jobs either in a thread pool or in a pool of pre-warmed processes.
+
+    Jobs must be module-level functions. In process mode image arguments and
+    image results are moved through shared memory instead of being pickled.
+    """
+    def __init__(self, kind: str, workers: int, initializer=None, initargs=()):
+        self.kind = kind
+        self.workers = workers
+        if kind == EXECUTOR_THREAD:
+            if initializer is not None:
+                initializer(*initargs)
+            self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photo_tasker")
+        elif kind == EXECUTOR_PROCESS:
+            self.pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=initializer,
+                initargs=initargs,
+            )
+            for _ in range(workers):
+                self.pool.submit(_warm_up)
+        else:
+            raise ValueError(f"unknown photo executor {kind}, expected {EXECUTOR_THREAD} or {EXECUTOR_PROCESS}")
+        logger.info(f"photo executor: {kind} with {workers} workers")
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.kind == EXECUTOR_THREAD:
+            return await loop.run_in_executor(self.pool, functools.partial(func, *args, **kwargs))
+
+        exported = [_export(a) for a in args]
+        try:
+            ret = await loop.run_in_executor(self.pool, _run_in_worker, func, exported, kwargs)
+        except BaseException:
+            # the worker may not have picked up its inputs
+            for a in exported:
+                _release(a)
+            raise
+        return _import(ret)
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait, cancel_futures=True)
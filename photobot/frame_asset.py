@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+import logging
+import yaml
+import PIL.Image as Image
+from .config import LayerSettings, LayerStackSettings
+from .pipeline.fused import FramePlanes
+from .pipeline.layers import FlatStack, flatten, BLEND_MODES, FILTERS
+
+logger = logging.getLogger(__name__)
+
+# the stack used when the layers file does not exist
+DEFAULT_STACK = {"layers": [{"photo": True, "filters": [{"contrast": 1.10}]}, {"file": "static/frame.png"}]}
+
+# filename -> (mtime, value), see file_digest() and load_stack()
+_digests = dict()
+_stacks = dict()
+
+def _mtime(filename: str) -> int|None:
+    try:
+        return os.stat(filename).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def file_digest(filename: str) -> str:
+    """Hash of the file contents, recomputed only when its mtime changes."""
+    mtime = _mtime(filename)
+    cached = _digests.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(filename, "rb") as f:
+            cached = _digests[filename] = (mtime, hashlib.sha256(f.read()).hexdigest())
+    return cached[1]
+
+def load_stack(filename: str) -> list[LayerSettings]:
+    """Parse and check the layers file, raises ValueError on a bad stack."""
+    mtime = _mtime(filename)
+    cached = _stacks.get(filename)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    if mtime is None:
+        data = DEFAULT_STACK
+    else:
+        with open(filename) as f:
+            data = yaml.safe_load(f)
+    layers = LayerStackSettings(**data).layers
+    if sum(1 for layer in layers if layer.photo) != 1:
+        raise ValueError(f"{filename}: exactly one layer has to be the photo")
+    for layer in layers:
+        if layer.photo and (layer.file is not None or layer.blend != "normal" or layer.opacity != 1):
+            raise ValueError(f"{filename}: the photo layer only takes filters")
+        if not layer.photo and layer.file is None:
+            raise ValueError(f"{filename}: layer without a file")
+        if layer.blend not in BLEND_MODES:
+            raise ValueError(f"{filename}: unknown blend mode {layer.blend}, expected one of {tuple(BLEND_MODES)}")
+        if not 0 <= layer.opacity <= 1:
+            raise ValueError(f"{filename}: opacity {layer.opacity} is not within 0..1")
+        for f in layer.filters:
+            if len(f) != 1 or next(iter(f)) not in FILTERS:
+                raise ValueError(f"{filename}: filters are single {tuple(FILTERS)} entries, got {f}")
+    _stacks[filename] = (mtime, layers)
+    return layers
+
+def stack_digest(filename: str) -> str:
+    """Hash of the stack and its images, changes whenever the rendered avatars may."""
+    layers = load_stack(filename)
+    parts = [file_digest(filename) if _mtime(filename) is not None else repr(DEFAULT_STACK)]
+    parts += [file_digest(layer.file) for layer in layers if not layer.photo]
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+class FrameAsset(object):
+    """Layer stack around the photo, flattened once at the sizes the pipeline uses.
+
+    The layers file and the layer images are re-read when one of their mtimes
+    changes, so the design can be swapped without a restart. Returned stacks
+    are shared between photo_tasker threads and must be treated as read-only.
+    """
+    def __init__(self, filename: str, sizes: list[int]):
+        self.filename = filename
+        self.sizes = list(sizes)
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._layers = []
+        self._images = dict()
+        self._flat = dict()
+        self._planes = dict()
+        self.reload()
+
+    def _stat(self) -> tuple:
+        return (_mtime(self.filename),) + tuple(os.stat(layer.file).st_mtime_ns for layer in self._layers if not layer.photo)
+
+    def reload(self):
+        with self._lock:
+            self._reload_locked()
+
+    def _reload_locked(self):
+        layers = load_stack(self.filename)
+        images = dict()
+        for layer in layers:
+            if layer.photo or layer.file in images:
+                continue
+            with Image.open(layer.file) as img:
+                images[layer.file] = img.convert("RGBA") if img.mode != "RGBA" else img.copy()
+        flat = dict()
+        for size in self.sizes:
+            flat[size] = flatten(layers, images, size)
+        # swap in one go so readers never see a half-built cache
+        self._layers = layers
+        self._images = images
+        self._flat = flat
+        self._planes = dict()
+        self._mtime = self._stat()
+        steps = flat[self.sizes[0]].steps if self.sizes else []
+        logger.info(f"layers {self.filename} loaded, {len(layers)} layers in {len(steps)} steps above the photo at {self.sizes}")
+
+    def _check(self):
+        try:
+            mtime = self._stat()
+        except OSError as e:
+            logger.error(f"layers of {self.filename} are not accessible, keeping cached ones: {e}")
+            return
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        self._reload_locked()
+                    except Exception as e:
+                        self._mtime = mtime
+                        logger.error(f"layers {self.filename} changed but could not be loaded, keeping cached ones: {e}")
+
+    def get(self, size: int) -> FlatStack:
+        """Return the stack flattened at size x size."""
+        self._check()
+        flat = self._flat
+        if size in flat:
+            return flat[size]
+        with self._lock:
+            if size not in self._flat:
+                logger.warning(f"layers requested at unexpected size {size}, flattening on demand")
+                self._flat = {**self._flat, size: flatten(self._layers, self._images, size)}
+            return self._flat[size]
+
+    def planes(self, size: int) -> FramePlanes:
+        """Return the overlay of a fusable stack at size x size as premultiplied arrays for the fused pipeline."""
+        self._check()
+        planes = self._planes
+        if size in planes:
+            return planes[size]
+        stack = self.get(size)
+        if not stack.fusable():
+            raise ValueError(f"the layer stack in {self.filename} needs the generic pipeline")
+        with self._lock:
+            if size not in self._planes:
+                self._planes = {**self._planes, size: FramePlanes(stack.overlay)}
+            return self._planes[size]
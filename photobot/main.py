@@ -3,21 +3,27 @@ import logging
 from .config import Config
 from .telegram import create_telegram_bot
 from .server import create_server
-from .photo_task import init_photo_tasker
+from .photo_task import init_photo_tasker, expire_tasks
 from .cached_localization import Localization
+from .stats import StatsSink
+from . import metrics
 from fluent.runtime import FluentResourceLoader
 from motor.motor_asyncio import AsyncIOMotorClient
 
 logger = logging.getLogger(__name__)
 
 class App(object):
+    config = None
     bot = None
     server = None
+    assets = None
     localization = None
     users_collection = None
+    stats = None
 
 async def main(cfg: Config):
     app = App()
+    app.config = cfg
     loader = FluentResourceLoader(cfg.localization.path)
     app.localization = Localization(loader, cfg.localization.file, cfg.localization.fallbacks)
 
@@ -25,8 +31,21 @@ async def main(cfg: Config):
         logger.info(f"db address {cfg.users_db.address}")
         mongodb = AsyncIOMotorClient(cfg.users_db.address).get_database()
         app.users_collection = mongodb[cfg.users_db.collection]
+        app.stats = StatsSink(
+            app.users_collection,
+            flush_size=cfg.users_db.flush_size,
+            flush_interval=cfg.users_db.flush_interval,
+            max_pending=cfg.users_db.max_pending,
+        )
+        app.stats.start()
+        metrics.register(metrics.Callback(
+            "photobot_user_stats_total", "User statistics updates by result.",
+            lambda: {"written": app.stats.written, "failed": app.stats.failed, "dropped": app.stats.dropped},
+            kind="counter", label="result",
+        ))
 
     init_photo_tasker(cfg)
+    expiry = asyncio.create_task(expire_tasks())
     await create_server(cfg, app)
     try:
         async with create_telegram_bot(cfg, app) as bot:
@@ -36,6 +55,10 @@ async def main(cfg: Config):
         pass
     except Exception as e:
         logger.exception(f"got exception {e}")
+    finally:
+        expiry.cancel()
+        if app.stats is not None:
+            await app.stats.close()
 
 if __name__ == "__main__":
     cfg = Config()
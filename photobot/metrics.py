@@ -0,0 +1,123 @@
+import bisect
+import time
+from contextlib import contextmanager
+
+# seconds, upper bounds of the histogram buckets
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# bytes
+SIZE_BUCKETS = (50e3, 100e3, 150e3, 200e3, 300e3, 400e3, 600e3, 800e3, 1.2e6, 2e6)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram(object):
+    """Prometheus histogram with one label, observations are a bisect and a few adds."""
+    def __init__(self, name: str, documentation: str, label: str, buckets=STAGE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = dict()
+
+    def observe(self, label_value: str, value: float):
+        series = self.series.get(label_value)
+        if series is None:
+            # per bucket counts (not cumulative, the last one is +Inf), sum
+            series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in sorted(self.series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{_number(bound)}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {_number(total)}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+class Counter(object):
+    def __init__(self, name: str, documentation: str, label: str):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.series = dict()
+
+    def inc(self, label_value: str, amount: int = 1):
+        self.series[label_value] = self.series.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_number(value)}')
+        return lines
+
+class Callback(object):
+    """Value read at scrape time, `func` returns a number or a dict of label value to number."""
+    def __init__(self, name: str, documentation: str, func, kind: str = "gauge", label: str|None = None):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+        self.kind = kind
+        self.label = label
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        value = self.func()
+        if isinstance(value, dict):
+            for label_value, v in sorted(value.items()):
+                lines.append(f'{self.name}{{{self.label}="{_escape(label_value)}"}} {_number(v)}')
+        elif value is not None:
+            lines.append(f"{self.name} {_number(value)}")
+        return lines
+
+stages = Histogram("photobot_stage_duration_seconds", "Time spent per processing stage.", "stage")
+conversations = Counter("photobot_conversations_total", "Avatar conversations by outcome.", "outcome")
+encode_seconds = Histogram("photobot_encode_seconds", "Final image encode time by encoder profile.", "profile")
+encoded_bytes = Histogram("photobot_encoded_bytes", "Final image size by encoder profile.", "profile", buckets=SIZE_BUCKETS)
+upload_bytes = Histogram("photobot_upload_bytes", "Web app crop upload size by image format.", "format", buckets=SIZE_BUCKETS)
+client_encode_seconds = Histogram(
+    "photobot_client_encode_seconds", "Web app crop encode time reported by the client, by image format.", "format",
+)
+registry = [stages, conversations, encode_seconds, encoded_bytes, upload_bytes, client_encode_seconds]
+
+def register(metric):
+    """Add a metric, replacing one of the same name."""
+    registry[:] = [m for m in registry if m.name != metric.name] + [metric]
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def observe_stages(timings: dict):
+    for stage, seconds in timings.items():
+        stages.observe(stage, seconds)
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages.observe(stage, time.perf_counter() - start)
+
+class StageTimer(object):
+    """Collects stage durations inside image jobs, they come back as a plain dict with the result."""
+    def __init__(self):
+        self.timings = dict()
+        self.last = time.perf_counter()
+
+    def mark(self, stage: str):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self.last
+        self.last = now
@@ -1,61 +1,206 @@
-from telegram import Chat, User
 import time
 import os
+import re
+import glob
+import io
 import uuid
 import PIL.Image as Image
-from PIL import ImageOps
+from PIL import ImageOps, ExifTags
 import math
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from functools import wraps
 import logging
 import numpy as np
-from .config import Config
+from .config import Config, EncoderProfile
+from .frame_asset import FrameAsset, load_stack, stack_digest
+from .executor import ImageExecutor
+from .admission import AdmissionController, PRIORITY_FINALIZE, PRIORITY_CROP, PRIORITY_PREVIEW
+from . import metrics
+from .metrics import StageTimer
+from .result_cache import ResultCache
+from .task_store import TaskStore, MemoryTaskStore, SQLiteTaskStore, TASK_STORE_MEMORY, TASK_STORE_SQLITE, TASK_STORES
+from .pipeline import fused_pipeline, render_stack, ENGINE_FUSED, ENGINES, PIPELINE_VERSION
 
 logger = logging.getLogger(__name__)
 
 DEADLINE_BASIC = 24*60*60 # 24 hours
 
+# expiry sweeper: longest sleep between passes and tasks evicted per batch
+EXPIRY_INTERVAL = 60
+EXPIRY_BATCH = 100
+
 real_frame_size = 1080
 
 files_path = "photos"
 
-frame_filename =  "static/frame.png"
+# layer stack composited with the photo, see layers/stack.yaml
+layers_file = "layers/stack.yaml"
 
 final_frame_size = 1000
 jpeg_quality = 90
 
-tasks_by_uuid = dict()
-tasks_by_user = dict()
-tasks_by_chat = dict()
+# final image writers: PIL format -> file extension
+ENCODER_FORMATS = {"JPEG": "jpg", "WEBP": "webp"}
+# web app crop uploads: PIL format -> file extension
+UPLOAD_FORMATS = {"PNG": "png", "WEBP": "webp", "JPEG": "jpg"}
+# name -> save() arguments, set up from photo.encoder_profiles
+encoder_profiles = {"default": {"format": "JPEG", "quality": jpeg_quality, "optimize": True}}
+encoder_profile = "default"
+fast_encoder_profile = None
+fast_encoder_queue = 4
+
+# web app previews of the original photo
+preview_sizes = (512, 1024, 2048, 4096)
+preview_formats = {"webp": "webp", "jpeg": "jpg"}
+preview_quality = 85
+
+# incoming photos up to this size are downloaded into memory and written once
+download_memory_limit = 2*1024*1024
+
+# In-memory cropped stages, spilled to disk once the budget is used up.
+# Only touched from the event loop.
+crop_memory_budget = 256*1024*1024
+crop_memory_used = 0
+
+task_store: TaskStore = MemoryTaskStore()
 
-main_executor = None
+# received photos and finished avatars by telegram file_unique_id, None when disabled
+result_cache: ResultCache|None = None
+# everything besides the photo, crop and frame that changes a cached result
+result_version = str(PIPELINE_VERSION)
+AUTOCROP_MODE = "auto"
+
+# refreshed by expire_tasks()
+task_stats = {"disk_bytes": 0, "expired": 0}
+
+# files init_photo_tasker may clean up: task files and partial uploads
+TASK_FILE = re.compile(r"^(?:([0-9a-f]{32})[._].*|upload_[0-9a-f]{32}\.part)$")
+
+main_executor: ImageExecutor = None
+admission: AdmissionController = None
+frame_asset: FrameAsset = None
+pipeline_engine = ENGINE_FUSED
 
 
 class ModelNotFoundException(Exception):
     pass
 
-def init_photo_tasker(cfg: Config):
-    global main_executor, files_path
-    main_executor = ThreadPoolExecutor(max_workers=cfg.photo.cpu_threads, thread_name_prefix="photo_tasker")
+def _init_worker(stack_file: str, frame_sizes: list[int], engine: str):
+    """Prepare an image worker: load PIL plugins, the layer stack and the pipeline engine."""
+    global frame_asset, pipeline_engine
+    Image.init()
+    frame_asset = FrameAsset(stack_file, frame_sizes)
+    pipeline_engine = engine
+
+def encoder_args(profile: EncoderProfile) -> dict:
+    """save() arguments of an encoder profile."""
+    if profile.format not in ENCODER_FORMATS:
+        raise ValueError(f"unsupported encoder format {profile.format}, expected one of {tuple(ENCODER_FORMATS)}")
+    if profile.format == "WEBP":
+        return {"format": "WEBP", "quality": profile.quality, "method": profile.method}
+    return {
+        "format": "JPEG", "quality": profile.quality, "optimize": profile.optimize,
+        "progressive": profile.progressive, "subsampling": profile.subsampling,
+    }
+
+def select_encoder_profile() -> str:
+    """The fast profile while the admission queue is deep, the configured one otherwise."""
+    if fast_encoder_profile is not None and admission is not None and admission.depth() >= fast_encoder_queue:
+        logger.info(f"{admission.depth()} image jobs waiting, encoding with the {fast_encoder_profile} profile")
+        return fast_encoder_profile
+    return encoder_profile
+
+def create_task_store(cfg: Config) -> TaskStore:
+    if cfg.photo.task_store == TASK_STORE_MEMORY:
+        return MemoryTaskStore()
+    if cfg.photo.task_store == TASK_STORE_SQLITE:
+        return SQLiteTaskStore(os.path.join(cfg.photo.storage_path, cfg.photo.task_db), PhotoTask.restore)
+    raise ValueError(f"unknown task store {cfg.photo.task_store}, expected one of {TASK_STORES}")
 
+def init_photo_tasker(cfg: Config):
+    global main_executor, admission, files_path, crop_memory_budget, task_store, download_memory_limit
+    global result_cache, result_version, layers_file
+    global encoder_profiles, encoder_profile, fast_encoder_profile, fast_encoder_queue
+    if cfg.photo.pipeline_engine not in ENGINES:
+        raise ValueError(f"unknown pipeline engine {cfg.photo.pipeline_engine}, expected one of {ENGINES}")
+    # fail here rather than in every worker
+    layers_file = cfg.photo.layers_file
+    load_stack(layers_file)
+    encoder_profiles = {name: encoder_args(profile) for name, profile in cfg.photo.encoder_profiles.items()}
+    for name in (cfg.photo.encoder_profile, cfg.photo.fast_encoder_profile):
+        if name is not None and name not in encoder_profiles:
+            raise ValueError(f"unknown encoder profile {name}, expected one of {tuple(encoder_profiles)}")
+    encoder_profile = cfg.photo.encoder_profile
+    fast_encoder_profile = cfg.photo.fast_encoder_profile
+    fast_encoder_queue = cfg.photo.fast_encoder_queue
+    main_executor = ImageExecutor(
+        cfg.photo.executor,
+        cfg.photo.cpu_threads,
+        initializer=_init_worker,
+        initargs=(layers_file, [real_frame_size, final_frame_size], cfg.photo.pipeline_engine),
+    )
+    admission = AdmissionController(main_executor, cfg.photo.cpu_threads, cfg.photo.max_queue)
+    _register_metrics()
+
+    crop_memory_budget = cfg.photo.crop_memory_budget
+    download_memory_limit = cfg.photo.download_memory_limit
     files_path = cfg.photo.storage_path
     if not os.path.exists(files_path):
         os.makedirs(files_path)
-    for file_name in os.listdir(files_path):
-        file_path = os.path.join(files_path, file_name)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-        elif os.path.isdir(file_path):
-            os.rmdir(file_path)
+    task_store = create_task_store(cfg)
+    result_cache = None
+    if cfg.photo.cache_size > 0:
+        # only avatars of the configured profile are cached, fast ones are a stopgap
+        encoder = sorted(encoder_profiles[encoder_profile].items())
+        result_version = f"{PIPELINE_VERSION}:{cfg.photo.pipeline_engine}:{final_frame_size}:{encoder}"
+        result_cache = ResultCache(os.path.join(files_path, cfg.photo.cache_path), cfg.photo.cache_size)
+        metrics.register(metrics.Callback(
+            "photobot_cache_requests_total", "Result cache lookups by entry kind and outcome.",
+            result_cache.requests, kind="counter", label="outcome",
+        ))
+        metrics.register(metrics.Callback("photobot_cache_bytes", "Bytes of files in the result cache.", lambda: result_cache.bytes))
+
+    # re-adopt tasks of the previous run whose conversation can still continue
+    live = set()
+    timeout = cfg.photo.conversation_timeout.total_seconds()
+    for task in task_store.load():
+        if time.time() - task.start_date > timeout or task.file is None or not os.path.isfile(task.file):
+            task.delete()
+            continue
+        live.add(task.id.hex)
+    logger.info(f"re-adopted {len(live)} tasks from the {cfg.photo.task_store} task store")
 
-def async_thread(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        # if executor == MAIN:
-        e = main_executor
-        return asyncio.get_event_loop().run_in_executor(e, lambda: func(*args, **kwargs))
-    return wrapper
+    for file_name in os.listdir(files_path):
+        match = TASK_FILE.match(file_name)
+        if match is None or match.group(1) in live:
+            continue
+        _unlink(os.path.join(files_path, file_name))
+
+def _register_metrics():
+    metrics.register(metrics.Callback("photobot_queue_depth", "Image jobs waiting for admission.", admission.depth))
+    metrics.register(metrics.Callback("photobot_workers_busy", "Image jobs running in the executor.", lambda: admission.running))
+    metrics.register(metrics.Callback("photobot_workers", "Image executor workers.", lambda: admission.slots))
+    metrics.register(metrics.Callback(
+        "photobot_jobs_total", "Image jobs by admission decision.",
+        lambda: {"admitted": admission.admitted, "rejected": admission.rejected}, kind="counter", label="decision",
+    ))
+    metrics.register(metrics.Callback("photobot_tasks", "Live photo tasks.", lambda: task_store.count()))
+    metrics.register(metrics.Callback(
+        "photobot_storage_bytes", "Bytes of task files in storage_path, as of the last expiry pass.",
+        lambda: task_stats["disk_bytes"],
+    ))
+    metrics.register(metrics.Callback(
+        "photobot_tasks_expired_total", "Tasks removed by the expiry sweeper.", lambda: task_stats["expired"], kind="counter",
+    ))
+    metrics.register(metrics.Callback(
+        "photobot_crop_memory_bytes", "Bytes of cropped stages held in memory.", lambda: crop_memory_used,
+    ))
+
+async def run_image_job(func, *args, priority: int = PRIORITY_CROP, user_id: int|None = None, on_queued=None, **kwargs):
+    """Run a module-level image job in the configured photo executor, once admitted.
+
+    Raises QueueFull or UserBusy when the job is not admitted.
+    """
+    return await admission.run(func, *args, priority=priority, user_id=user_id, on_queued=on_queued, **kwargs)
 
 
 def centered_crop_with_padding(img, x, y, size):
@@ -109,156 +254,624 @@ def img_transform(img, a, b, c, d, e, f):
     return centered_crop_with_padding(img, -e, -f, real_frame_size)
 
 
+# EXIF orientations that swap width and height
+EXIF_TRANSPOSED = (5, 6, 7, 8)
+
+def exif_orientation(img: Image.Image) -> int:
+    return img.getexif().get(ExifTags.Base.Orientation, 1)
+
+def oriented_size(img: Image.Image) -> tuple[int, int]:
+    """Size of the image as shown, with its EXIF Orientation applied like browsers do."""
+    if exif_orientation(img) in EXIF_TRANSPOSED:
+        return img.height, img.width
+    return img.size
+
+def open_for_frame(file, short_side: int = real_frame_size) -> Image.Image:
+    """Open an image decoded at the smallest scale whose short side still covers short_side.
+
+    JPEG files are decoded with DCT scaling (1/2, 1/4 or 1/8), other formats are
+    decoded fully. The EXIF Orientation is applied, as the web app sees the photo.
+    `Image.info["original_size"]` keeps the oriented size stored in the file.
+    """
+    img = Image.open(file)
+    # draft() works on the stored pixels, the orientation is applied afterwards
+    original_size = img.size
+    if img.format == "JPEG" and min(original_size) >= 2 * short_side:
+        k = short_side / min(original_size)
+        start = time.perf_counter()
+        img.draft(img.mode, (math.ceil(original_size[0] * k), math.ceil(original_size[1] * k)))
+        img.load()
+        elapsed = time.perf_counter() - start
+        full_pixels = original_size[0] * original_size[1]
+        pixels = img.size[0] * img.size[1]
+        saved = (full_pixels - pixels) * len(img.getbands())
+        # IDCT and colour conversion dominate and scale with the output pixels
+        logger.info(
+            f"decoded {original_size} JPEG at {img.size} in {elapsed*1000:.0f} ms, "
+            f"{saved/2**20:.1f} MiB less, ~{elapsed*(full_pixels/pixels - 1)*1000:.0f} ms saved (est.)"
+        )
+    if exif_orientation(img) in EXIF_TRANSPOSED:
+        original_size = original_size[::-1]
+    if exif_orientation(img) != 1:
+        with img:
+            img = ImageOps.exif_transpose(img)
+    img.info["original_size"] = original_size
+    return img
+
+def affine_render(img, a, b, c, d, e, f, size=real_frame_size):
+    """Render the web app transform into a size x size square with a single affine resample.
+
+    The matrix [[a,c,e],[b,d,f]] is in real frame units, with the photo centered at
+    the origin, exactly as fit_frame.mjs draws it: translate(e,f), scale, rotate.
+    It refers to the photo at `img.info["original_size"]` when the image was
+    decoded at a reduced scale.
+    """
+    scaling_x = math.sqrt(a * a + c * c)
+    scaling_y = math.sqrt(b * b + d * d)
+    if scaling_x == 0 or scaling_y == 0:
+        raise ValueError("degenerate transform")
+    rotation = math.atan2(b, a)
+    original_w, original_h = img.info.get("original_size", img.size)
+    k = size / real_frame_size
+
+    # Affine resampling does not filter, shrink strong downscales with a box filter first.
+    reduce_factor = int(img.width / (original_w * max(scaling_x, scaling_y) * k))
+    if reduce_factor >= 2:
+        img = img.reduce(reduce_factor)
+    if img.mode != "RGBA":
+        img = img.convert("RGBA")
+
+    # output point o = center + k * (S * R * (p - photo_center) + (e, f)), solved for p
+    # in original photo pixels, then scaled to the pixels actually decoded
+    cos, sin = math.cos(rotation), math.sin(rotation)
+    ia, ib = cos / (scaling_x * k), sin / (scaling_y * k)
+    ic, id = -sin / (scaling_x * k), cos / (scaling_y * k)
+    ox = size / 2 + k * e
+    oy = size / 2 + k * f
+    rx = img.width / original_w
+    ry = img.height / original_h
+    data = (
+        ia * rx, ib * rx, (original_w / 2 - ia * ox - ib * oy) * rx,
+        ic * ry, id * ry, (original_h / 2 - ic * ox - id * oy) * ry,
+    )
+    return img.transform((size, size), Image.AFFINE, data, resample=Image.BICUBIC, fillcolor=(0,0,0,0))
+
+def transform_mode(a: float,b: float,c: float,d: float,e: float,f: float) -> str:
+    """Result cache mode of a web app transform, equal for transforms that render the same."""
+    return "matrix:" + ",".join(f"{v:.4g}" for v in (a,b,c,d)) + "," + ",".join(f"{v:.1f}" for v in (e,f))
+
+# Crops are rendered straight at the avatar resolution: the photo is sampled
+# once and composited with the layers flattened at that size, finalize_job
+# does not resample again. 1080 crops (web app uploads) still work.
+def transform_job(file: str, a: float,b: float,c: float,d: float,e: float,f: float, size: int = final_frame_size) -> tuple[Image.Image, dict]:
+    timer = StageTimer()
+    with Image.open(file) as img:
+        # pixels of the original needed across the short side at this zoom
+        needed = min(img.size) * max(math.hypot(a, c), math.hypot(b, d)) * size / real_frame_size
+    with open_for_frame(file, max(1, math.ceil(needed))) as img:
+        img.load()
+        timer.mark("decode")
+        cropped = affine_render(img, a,b,c,d,e,f, size=size)
+        timer.mark("crop")
+        return cropped, timer.timings
+
+def autocrop_box(width: int, height: int) -> tuple[int, int, int, int]:
+    """The centered square of a width x height photo."""
+    side = min(width, height)
+    left, top = (width - side) // 2, (height - side) // 2
+    return (left, top, left + side, top + side)
+
+def autocrop_job(file: str, size: int = final_frame_size) -> tuple[Image.Image, dict]:
+    timer = StageTimer()
+    with open_for_frame(file, size) as img:
+        img.load()
+        timer.mark("decode")
+        # crop and scale in one resampling pass
+        cropped_img = img.resize((size, size), resample=Image.LANCZOS, box=autocrop_box(*img.size))
+    timer.mark("crop")
+    return cropped_img, timer.timings
+
+def preview_job(file: str, preview_file: str, max_side: int, fmt: str) -> dict:
+    timer = StageTimer()
+    with Image.open(file) as img:
+        # thumbnail() uses JPEG draft mode itself
+        img.thumbnail((max_side, max_side), resample=Image.LANCZOS)
+        # renditions carry no EXIF, the orientation goes into the pixels
+        img = ImageOps.exif_transpose(img)
+        if fmt == "jpeg" and img.mode != "RGB":
+            img = img.convert("RGB")
+        elif img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA")
+        img.save(preview_file, fmt.upper(), quality=preview_quality)
+    timer.mark("preview")
+    return timer.timings
+
+def spill_job(img: Image.Image, file: str):
+    # nobody downloads the spilled stage, trade size for encode time
+    img.save(file, 'PNG', compress_level=0)
+
+def finalize_job(cropped: Image.Image|bytes|str, final_file: str, encoder: dict|None = None) -> dict:
+    """Composite, scale and encode the avatar, `encoder` holds save() arguments (see encoder_args)."""
+    timer = StageTimer()
+    if isinstance(cropped, Image.Image):
+        source = cropped
+    else:
+        if isinstance(cropped, bytes):
+            source = Image.open(io.BytesIO(cropped))
+        else:
+            source = Image.open(cropped)
+        source.load()
+        timer.mark("decode")
+
+    # Crops of transform_job and autocrop_job come at the final size. Anything
+    # else is normalized to a real_frame_size square, the layers are cached at both.
+    size = final_frame_size if source.size == (final_frame_size, final_frame_size) else real_frame_size
+    try:
+        if source.size != (size, size):
+            logger.warning("Uploaded cropped source size %s != expected %s; resizing", source.size, real_frame_size)
+            source = source.resize((real_frame_size, real_frame_size), resample=Image.LANCZOS)
+    except Exception as e:
+        logger.error("Error normalizing sizes: %s", e, exc_info=1)
+
+    stack = frame_asset.get(size)
+    if pipeline_engine == ENGINE_FUSED and stack.fusable():
+        composition = fused_pipeline(source, frame_asset.planes(size), stack.contrast)
+    else:
+        composition = render_stack(source, stack)
+    timer.mark("pipeline")
+
+    final = composition
+    if size != final_frame_size:
+        final = composition.resize(
+            (final_frame_size, final_frame_size),
+            resample=Image.LANCZOS
+        )
+    if final.mode != 'RGB':
+        final = final.convert('RGB')
+    timer.mark("resize")
+
+    if encoder is None:
+        encoder = encoder_profiles["default"]
+    final.save(final_file, **encoder)
+    timer.mark("encode")
+    return timer.timings
+
+
 class PhotoTask(object):
-    debug_code = None
-    
-    def __init__(self, chat: Chat, user: User) -> None:
-        self.chat = chat
-        self.user = user
-        self.start_date = time.time()
-
-        if self.chat.id in tasks_by_chat:
-            tasks_by_chat[self.chat.id].delete()
-        if self.user.id in tasks_by_user:
-            tasks_by_user[self.user.id].delete()
+    """A user's photo on its way to a framed avatar.
+
+    Only ids are kept for the chat and user, so a task record stays small
+    and does not hold on to telegram objects.
+    """
+    __slots__ = (
+        "chat_id", "user_id", "start_date", "id", "file", "file_size", "cropped", "cropped_nbytes",
+        "cropped_file", "final_file", "previews", "debug_code", "source_id", "result_mode",
+    )
+
+    def __init__(self, chat_id: int, user_id: int) -> None:
+        self._init_state(chat_id, user_id, time.time())
+
+        for lookup, key in ((get_by_chat, chat_id), (get_by_user, user_id)):
+            try:
+                lookup(key).delete()
+            except KeyError:
+                pass
         self.id = uuid.uuid4()
-        while self.id in tasks_by_uuid:
+        while _exists(self.id):
             self.id = uuid.uuid4()
-        
+
+        task_store.add(self)
+
+    def _init_state(self, chat_id: int, user_id: int, start_date: float):
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.start_date = start_date
         self.file = None
+        self.file_size = None
+        self.cropped = None
+        self.cropped_nbytes = 0
         self.cropped_file = None
         self.final_file = None
-        self.tg_update = None
-        self.tg_context = None
-        
-        tasks_by_uuid[self.id] = self
-        tasks_by_chat[self.chat.id] = self
-        tasks_by_user[self.user.id] = self
+        self.previews = dict()
+        self.debug_code = None
+        # telegram file_unique_id of the photo, and the crop mode the cropped stage was made with
+        self.source_id = None
+        self.result_mode = None
+
+    @classmethod
+    def restore(cls, record: dict) -> "PhotoTask":
+        """Task object for a record of a persistent task store."""
+        task = cls.__new__(cls)
+        task._init_state(record["chat_id"], record["user_id"], record["start_date"])
+        task.id = record["id"]
+        task.refresh(record)
+        return task
+
+    def refresh(self, record: dict):
+        if record["cropped_file"] is not None and record["cropped_file"] != self.cropped_file:
+            # a newer crop was stored meanwhile
+            self._release_cropped()
+        if record["file"] != self.file:
+            self.file_size = None
+        self.file = record["file"]
+        self.cropped_file = record["cropped_file"]
+        self.final_file = record["final_file"]
+        self.debug_code = record["debug_code"]
+        self.source_id = record["source_id"]
+
+    def save(self):
+        task_store.save(self)
             
-    @async_thread
-    def transform_avatar(self, a: float,b: float,c: float,d: float,e: float,f: float):
-        file = self.file
-        with Image.open(file) as img:
-            if img.mode != "RGBA":
-                img = img.convert("RGBA")
-            cropped_img = img_transform(img, a,b,c,d,e,f)
-
-        fn = self.get_cropped_file(True)
-        cropped_img.save(fn, 'PNG')
-        self.cropped_file = fn
-    
-    @async_thread
-    def resize_avatar(self):
-        file = self.file
-        with Image.open(file) as img:
-            pw, ph = img.size
-            left = right = top = bottom = 0
-            if pw < ph:
-                top = (ph-pw)//2
-                bottom = top+pw
-                right = pw
-            else:
-                left = (pw-ph)//2
-                right = left + ph
-                bottom = ph
-            cropped_img = img.crop((left,top,right,bottom))
-        resized_img = cropped_img.resize((real_frame_size, real_frame_size), resample=Image.LANCZOS)
-
-        fn = self.get_cropped_file(True)
-        resized_img.save(fn, 'PNG')
-        self.cropped_file = fn
-    
-    @async_thread
-    def finalize_avatar(self):
-        source = Image.open(self.get_cropped_file())
-        frame = Image.open(frame_filename)
-
-        # Normalize sizes: ensure source is real_frame_size square and frame matches it.
-        try:
-            if source.size != (real_frame_size, real_frame_size):
-                logger.warning("Uploaded cropped source size %s != expected %s; resizing", source.size, real_frame_size)
-                source = source.resize((real_frame_size, real_frame_size), resample=Image.LANCZOS)
-            if frame.size != source.size:
-                logger.warning("Frame size %s != source size %s; resizing frame", frame.size, source.size)
-                frame = frame.resize(source.size, resample=Image.LANCZOS)
-        except Exception as e:
-            logger.error("Error normalizing sizes: %s", e, exc_info=1)
-
-        from .pipeline import pipeline
-
-        composition = pipeline(source, frame)
+    async def transform_avatar(self, a: float,b: float,c: float,d: float,e: float,f: float, on_queued=None):
+        cropped, timings = await run_image_job(
+            transform_job, self.file, a,b,c,d,e,f, user_id=self.user_id, on_queued=on_queued,
+        )
+        metrics.observe_stages(timings)
+        await self.set_cropped(cropped)
+        self.result_mode = transform_mode(a,b,c,d,e,f)
+
+    async def resize_avatar(self, on_queued=None):
+        cropped, timings = await run_image_job(autocrop_job, self.file, user_id=self.user_id, on_queued=on_queued)
+        metrics.observe_stages(timings)
+        await self.set_cropped(cropped)
+        self.result_mode = AUTOCROP_MODE
+
+    async def finalize_avatar(self, on_queued=None):
+        profile = select_encoder_profile()
+        encoder = encoder_profiles[profile]
+        final_name = self.get_final_file(True, ENCODER_FORMATS[encoder["format"]])
+        timings = await run_image_job(
+            finalize_job, self.get_cropped(), final_name, encoder,
+            priority=PRIORITY_FINALIZE, user_id=self.user_id, on_queued=on_queued,
+        )
+        metrics.observe_stages(timings)
+        metrics.encode_seconds.observe(profile, timings["encode"])
+        metrics.encoded_bytes.observe(profile, os.path.getsize(final_name))
+        self.final_file = final_name
+        self.save()
+        name = self._result_name(self.result_mode)
+        if name is not None and profile == encoder_profile:
+            await result_cache.put(name, final_name)
+
+    def _result_name(self, mode: str|None) -> str|None:
+        if result_cache is None or self.source_id is None or mode is None:
+            return None
+        ext = ENCODER_FORMATS[encoder_profiles[encoder_profile]["format"]]
+        return result_cache.result_name(self.source_id, mode, stack_digest(layers_file), result_version, ext)
+
+    async def final_from_cache(self, mode: str) -> bool:
+        """Take the final avatar for the crop `mode` from the result cache, True on a hit."""
+        name = self._result_name(mode)
+        if name is None:
+            return False
+        final_name = self.get_final_file(True, os.path.splitext(name)[1][1:])
+        if not await result_cache.fetch(name, final_name):
+            return False
+        self.final_file = final_name
+        self.save()
+        return True
+
+    async def file_from_cache(self, source_id: str, ext: str) -> bool:
+        """Take the photo from the result cache instead of downloading it, True on a hit."""
+        self.source_id = source_id
+        if result_cache is None:
+            return False
+        if self.file is not None:
+            self.remove_file()
+        new_name = os.path.join(files_path, f"{self.id.hex}.{ext}")
+        if not await result_cache.fetch(result_cache.source_name(source_id, ext), new_name):
+            return False
+        self.file = new_name
+        self.save()
+        return True
 
-        final = composition.resize(
-            (final_frame_size, final_frame_size),
-            resample=Image.LANCZOS
-        ).convert('RGB')
+    async def cache_file(self, ext: str):
+        if result_cache is not None and self.source_id is not None and self.file is not None:
+            await result_cache.put(result_cache.source_name(self.source_id, ext), self.file)
 
-        final_name = self.get_final_file(True)
-        final.save(final_name, quality=jpeg_quality, optimize=True)
-        self.final_file = final_name
-    
     def get_file_size(self):
-        file = self.file
-        with Image.open(file) as img:
-            return img.size
+        if self.file_size is None:
+            # Image.open only parses the header, no pixels are decoded here
+            with Image.open(self.file) as img:
+                self.file_size = oriented_size(img)
+        return self.file_size
     
     def is_file_small(self):
         w,h = self.get_file_size()
         return w*h < real_frame_size*real_frame_size
 
-    def get_cropped_file(self, generate=False):
+    async def get_preview(self, max_side: int, fmt: str) -> str:
+        """File name of a downscaled rendition of the original, rendered on first request."""
+        max_side = next((size for size in preview_sizes if size >= max_side), preview_sizes[-1])
+        if fmt not in preview_formats:
+            raise ValueError(f"unsupported preview format {fmt}")
+        w, h = self.get_file_size()
+        if max(w, h) <= max_side:
+            return self.file
+        key = (max_side, fmt)
+        if key not in self.previews:
+            base_name, _ = os.path.splitext(self.file)
+            fn = f"{base_name}_preview_{max_side}.{preview_formats[fmt]}"
+            self.previews[key] = asyncio.ensure_future(self._render_preview(fn, max_side, fmt))
+        try:
+            return await asyncio.shield(self.previews[key])
+        except Exception:
+            self.previews.pop(key, None)
+            raise
+
+    async def _render_preview(self, fn: str, max_side: int, fmt: str) -> str:
+        metrics.observe_stages(await run_image_job(preview_job, self.file, fn, max_side, fmt, priority=PRIORITY_PREVIEW))
+        return fn
+
+    def remove_previews(self):
+        for future in self.previews.values():
+            # a rendition still in the works is removed once it is written
+            future.add_done_callback(_remove_preview)
+        self.previews = dict()
+        if self.file is not None:
+            # renditions left over from before a restart
+            base_name, _ = os.path.splitext(self.file)
+            for fn in glob.glob(glob.escape(base_name) + "_preview_*"):
+                _unlink(fn)
+
+    def get_cropped_file(self, generate=False, ext: str = "png"):
         if self.cropped_file is None and generate and self.file is not None:
             base_name, _ = os.path.splitext(self.file)
-            return base_name + "_cropped.png"
+            return f"{base_name}_cropped.{ext}"
         return self.cropped_file
 
-    def set_cropped_file_from_upload(self, data: bytes):
-        """Store already-cropped square PNG uploaded from the webapp."""
-        fn = self.get_cropped_file(True)
-        with open(fn, 'wb') as f:
-            f.write(data)
+    def _hold_cropped(self, cropped: Image.Image|bytes, nbytes: int) -> bool:
+        global crop_memory_used
+        if crop_memory_used + nbytes > crop_memory_budget:
+            logger.info(f"crop memory budget exhausted ({crop_memory_used} of {crop_memory_budget} bytes used), spilling to disk")
+            return False
+        crop_memory_used += nbytes
+        self.cropped = cropped
+        self.cropped_nbytes = nbytes
+        return True
+
+    async def set_cropped(self, img: Image.Image):
+        """Keep the cropped stage in memory, or on disk when over the budget."""
+        self.remove_cropped()
+        # PIL keeps RGB and RGBA pixels in 4 bytes
+        if not self._hold_cropped(img, img.width * img.height * 4):
+            fn = self.get_cropped_file(True)
+            with metrics.timed("spill"):
+                await run_image_job(spill_job, img, fn, user_id=self.user_id)
+            self.cropped_file = fn
+            self.save()
+
+    def set_cropped_from_upload(self, upload: "CroppedUpload"):
+        """Store already-cropped square image uploaded from the webapp."""
+        self.remove_cropped()
+        # a persistent store keeps the crop on disk, so it survives a restart
+        if upload.file is None and not task_store.persistent:
+            # the held crop takes over the reservation
+            upload.release()
+            if self._hold_cropped(bytes(upload.buffer), upload.nbytes):
+                upload.buffer = None
+                return
+        fn = self.get_cropped_file(True, UPLOAD_FORMATS[upload.format])
+        upload.save_as(fn)
         self.cropped_file = fn
+        self.save()
 
-    def get_final_file(self, generate=False):
+    def get_cropped(self) -> Image.Image|bytes|str|None:
+        """Cropped stage as an image or encoded bytes held in memory, or the spilled file path."""
+        if self.cropped is not None:
+            return self.cropped
+        return self.cropped_file
+
+    def _release_cropped(self):
+        global crop_memory_used
+        if self.cropped is not None:
+            crop_memory_used -= self.cropped_nbytes
+            self.cropped = None
+            self.cropped_nbytes = 0
+
+    def remove_cropped(self):
+        self._release_cropped()
+        self.result_mode = None
+        if self.cropped_file is not None:
+            _unlink(self.cropped_file)
+            self.cropped_file = None
+
+    def get_final_file(self, generate=False, ext: str = "jpg"):
         if self.final_file is None and generate and self.file is not None:
             base_name, _ = os.path.splitext(self.file)
-            return base_name + "_final.jpg"
+            return f"{base_name}_final.{ext}"
         return self.final_file
     
     def remove_file(self):
+        self.remove_previews()
         if self.file is not None:
-            os.remove(self.file)
+            _unlink(self.file)
             self.file = None
-        if self.cropped_file is not None:
-            os.remove(self.cropped_file)
-            self.cropped_file = None
+            self.file_size = None
+        self.remove_cropped()
         if self.final_file is not None:
-            os.remove(self.final_file)
+            _unlink(self.final_file)
             self.final_file = None
     
-    def add_file(self, file_name: str, ext: str):
+    async def download_file(self, tg_file, ext: str, size: int|None = None):
+        """Download a telegram File straight to the task storage, small files through memory."""
         if self.file is not None:
             self.remove_file()
         if not os.path.exists(files_path):
             os.makedirs(files_path)
         new_name = os.path.join(files_path, f"{self.id.hex}.{ext}")
-        os.rename(file_name, new_name)
+        try:
+            if size is not None and size <= download_memory_limit:
+                data = await tg_file.download_as_bytearray()
+                # the header is parsed from memory, this also rejects non-images before they hit the disk
+                with Image.open(io.BytesIO(data)) as img:
+                    file_size = oriented_size(img)
+                await asyncio.to_thread(_write_file, new_name, data)
+            else:
+                await tg_file.download_to_drive(new_name)
+                with Image.open(new_name) as img:
+                    file_size = oriented_size(img)
+        except BaseException:
+            _unlink(new_name)
+            raise
         self.file = new_name
+        self.file_size = file_size
+        self.save()
     
     def delete(self) -> None:
-        del tasks_by_chat[self.chat.id]
-        del tasks_by_user[self.user.id]
-        del tasks_by_uuid[self.id]
+        task_store.remove(self)
         self.remove_file()
 
+    def detach(self):
+        """Remove the task from the store and from memory, leaving its files for _remove_task_files."""
+        task_store.remove(self)
+        self._release_cropped()
+        for future in self.previews.values():
+            future.add_done_callback(_remove_preview)
+        self.previews = dict()
+
+def _write_file(file_name: str, data: bytes):
+    with open(file_name, "wb") as f:
+        f.write(data)
+
+def _unlink(file_name: str):
+    # expiry and cleanup may both get to a file, it may be gone already
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+def _remove_task_files(ids: list[str]) -> int:
+    # all files of a task are named after its id
+    removed = 0
+    for id_hex in ids:
+        for fn in glob.glob(os.path.join(glob.escape(files_path), id_hex + "*")):
+            _unlink(fn)
+            removed += 1
+    return removed
+
+def _disk_usage() -> int:
+    total = 0
+    with os.scandir(files_path) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and TASK_FILE.match(entry.name):
+                total += entry.stat(follow_symlinks=False).st_size
+    return total
+
+async def expire_tasks():
+    """Background loop evicting tasks older than DEADLINE_BASIC, files are deleted off the event loop."""
+    while True:
+        try:
+            while True:
+                expired = task_store.expired(time.time() - DEADLINE_BASIC, EXPIRY_BATCH)
+                if not expired:
+                    break
+                for task in expired:
+                    task.detach()
+                removed = await asyncio.to_thread(_remove_task_files, [task.id.hex for task in expired])
+                task_stats["expired"] += len(expired)
+                logger.info(f"expired {len(expired)} tasks, {removed} files removed")
+            task_stats["disk_bytes"] = await asyncio.to_thread(_disk_usage)
+        except Exception as e:
+            logger.error(f"task expiry failed: {e}", exc_info=1)
+
+        delay = EXPIRY_INTERVAL
+        oldest = task_store.oldest()
+        if oldest is not None:
+            delay = min(delay, max(1, oldest + DEADLINE_BASIC - time.time()))
+        await asyncio.sleep(delay)
+
+def _remove_preview(future: asyncio.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    _unlink(future.result())
+
+class CroppedUpload(object):
+    """Cropped image received chunk by chunk from the web app.
+
+    Small uploads that fit the crop memory budget stay in memory, others are
+    written to storage_path as they arrive and renamed into place on commit.
+    """
+    def __init__(self, expected_size: int|None = None):
+        self.nbytes = 0
+        # PIL format, sniffed by the server from the first bytes
+        self.format = "PNG"
+        self.buffer = None
+        self.file = None
+        self.path = None
+        # budget bytes held for the buffer until the upload is stored or dropped
+        self.reserved = 0
+        if expected_size is not None and not task_store.persistent and crop_memory_used + expected_size <= crop_memory_budget:
+            self._reserve(expected_size)
+            self.buffer = bytearray()
+        else:
+            self._open_file()
+
+    def _reserve(self, nbytes: int):
+        global crop_memory_used
+        crop_memory_used += nbytes
+        self.reserved = nbytes
+
+    def release(self):
+        """Return the reserved budget, the stored crop accounts for its own bytes."""
+        global crop_memory_used
+        crop_memory_used -= self.reserved
+        self.reserved = 0
+
+    def _open_file(self):
+        if not os.path.exists(files_path):
+            os.makedirs(files_path)
+        self.path = os.path.join(files_path, f"upload_{uuid.uuid4().hex}.part")
+        self.file = open(self.path, "wb")
+
+    def write(self, data: bytes):
+        self.nbytes += len(data)
+        if self.file is None and self.nbytes > self.reserved:
+            # longer than announced, the rest goes to disk
+            self._spill()
+        if self.file is not None:
+            self.file.write(data)
+        else:
+            self.buffer += data
+
+    def _spill(self):
+        self._open_file()
+        self.file.write(self.buffer)
+        self.buffer = None
+        self.release()
+
+    def save_as(self, file_name: str):
+        if self.file is None:
+            self._spill()
+        self.file.close()
+        os.replace(self.path, file_name)
+        self.file = None
+        self.path = None
+
+    def abort(self):
+        self.buffer = None
+        self.release()
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.path)
+            self.file = None
+            self.path = None
+
 def get_by_uuid(id: uuid.UUID|str) -> PhotoTask:
     if not isinstance(id, uuid.UUID):
         id = uuid.UUID(id)
-    return tasks_by_uuid[id]
+    return task_store.get_by_uuid(id)
 
 def get_by_chat(id: int) -> PhotoTask:
-    return tasks_by_chat[id]
+    return task_store.get_by_chat(id)
 
 def get_by_user(id: int) -> PhotoTask:
-    return tasks_by_user[id]
+    return task_store.get_by_user(id)
+
+def _exists(id: uuid.UUID) -> bool:
+    try:
+        task_store.get_by_uuid(id)
+    except KeyError:
+        return False
+    return True
 
@@ -1,18 +1,9 @@
-import PIL.Image as Image
-import PIL.ImageEnhance as Enhance
+from .fused import fused_pipeline, FramePlanes
+from .layers import render_stack, FlatStack
 
-def pipeline(source: Image.Image, frame: Image.Image) -> Image.Image:
-    source = source.convert('RGBA')
-    frame = frame.convert('RGBA')
+ENGINE_PIL = "pil"
+ENGINE_FUSED = "fused"
+ENGINES = (ENGINE_PIL, ENGINE_FUSED)
 
-    # Increase the contrast of the source image
-    enhancer = Enhance.Contrast(source)
-    source = enhancer.enhance(1.10)  # 10% increase in contrast
-
-    composition = Image.new('RGBA', source.size)
-
-    # Perform alpha compositing to combine the two images
-    composition.alpha_composite(source)
-    composition.alpha_composite(frame)
-
-    return composition
+# bump whenever a change alters the rendered avatars, cached results of older versions are not reused
+PIPELINE_VERSION = 2
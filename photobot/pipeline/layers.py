@@ -0,0 +1,132 @@
+import numpy as np
+import PIL.Image as Image
+import PIL.ImageEnhance as Enhance
+
+BLEND_NORMAL = "normal"
+
+# separable blend functions of backdrop and source colour, 0..1
+BLEND_MODES = {
+    BLEND_NORMAL: lambda cb, cs: cs,
+    "multiply": lambda cb, cs: cb * cs,
+    "screen": lambda cb, cs: cb + cs - cb * cs,
+    "overlay": lambda cb, cs: np.where(cb <= 0.5, 2 * cb * cs, 1 - 2 * (1 - cb) * (1 - cs)),
+    "darken": np.minimum,
+    "lighten": np.maximum,
+}
+
+FILTERS = {
+    "contrast": Enhance.Contrast,
+    "brightness": Enhance.Brightness,
+    "color": Enhance.Color,
+    "sharpness": Enhance.Sharpness,
+}
+
+def apply_filters(img: Image.Image, filters: list[tuple[str, float]]) -> Image.Image:
+    for name, factor in filters:
+        img = FILTERS[name](img).enhance(factor)
+    return img
+
+def with_opacity(img: Image.Image, opacity: float) -> Image.Image:
+    if opacity >= 1:
+        return img
+    img = img.copy()
+    img.putalpha(img.getchannel("A").point(lambda a: round(a * opacity)))
+    return img
+
+def blend(backdrop: Image.Image, layer: Image.Image, mode: str, opacity: float = 1.0) -> Image.Image:
+    """`layer` blended onto `backdrop` with `mode`, both RGBA with straight alpha (W3C compositing)."""
+    if mode == BLEND_NORMAL:
+        composition = backdrop.copy()
+        composition.alpha_composite(with_opacity(layer, opacity))
+        return composition
+    b = np.asarray(backdrop, dtype=np.float32) / 255
+    s = np.asarray(layer, dtype=np.float32) / 255
+    cb, ab = b[..., :3], b[..., 3:]
+    cs, as_ = s[..., :3], s[..., 3:] * opacity
+    # where the backdrop is transparent the layer shows unblended
+    cs = (1 - ab) * cs + ab * BLEND_MODES[mode](cb, cs)
+    ao = as_ + ab * (1 - as_)
+    co = (as_ * cs + (1 - as_) * ab * cb) / np.maximum(ao, 1e-6)
+    out = np.concatenate([co, ao], axis=-1) * 255 + 0.5
+    return Image.fromarray(np.clip(out, 0, 255).astype(np.uint8), "RGBA")
+
+class FlatStack(object):
+    """A layer stack at one size, with the static layers merged as far as compositing allows.
+
+    Everything below the photo is one `background` (or None). Above it,
+    consecutive normal layers are merged into one overlay, other blend
+    modes depend on the pixels under them and stay separate `steps` of
+    (mode, opacity, image). The default stack, one frame over a photo with
+    a contrast filter, is a single normal step.
+    """
+    __slots__ = ("size", "background", "filters", "steps")
+
+    def __init__(self, size: int, background: Image.Image|None, filters: list[tuple[str, float]], steps: list[tuple]):
+        self.size = size
+        self.background = background
+        self.filters = filters
+        self.steps = steps
+
+    @property
+    def contrast(self) -> float|None:
+        """The photo contrast factor when the fused kernel can render this stack, see fusable()."""
+        return self.filters[0][1] if self.filters else None
+
+    def fusable(self) -> bool:
+        """One normal overlay over a photo that at most gets a contrast filter."""
+        return (
+            self.background is None
+            and len(self.steps) == 1 and self.steps[0][0] == BLEND_NORMAL
+            and (not self.filters or (len(self.filters) == 1 and self.filters[0][0] == "contrast"))
+        )
+
+    @property
+    def overlay(self) -> Image.Image:
+        return self.steps[0][2]
+
+def flatten(layers: list, images: dict[str, Image.Image], size: int) -> FlatStack:
+    """Merge the static `layers` scaled to size x size, `images` maps layer files to RGBA originals."""
+    background = None
+    filters = []
+    steps = []
+    below = True
+    for layer in layers:
+        if layer.photo:
+            below = False
+            filters = [next(iter(f.items())) for f in layer.filters]
+            continue
+        img = images[layer.file]
+        if img.size != (size, size):
+            img = img.resize((size, size), resample=Image.LANCZOS)
+        img = apply_filters(img, [next(iter(f.items())) for f in layer.filters])
+        if below:
+            if background is None:
+                background = Image.new("RGBA", (size, size))
+            background = blend(background, img, layer.blend, layer.opacity)
+        elif layer.blend == BLEND_NORMAL:
+            img = with_opacity(img, layer.opacity)
+            if steps and steps[-1][0] == BLEND_NORMAL:
+                # source-over is associative, the merged overlay composites like the two layers
+                merged = steps[-1][2].copy()
+                merged.alpha_composite(img)
+                steps[-1] = (BLEND_NORMAL, 1.0, merged)
+            else:
+                steps.append((BLEND_NORMAL, 1.0, img))
+        else:
+            steps.append((layer.blend, layer.opacity, img))
+    return FlatStack(size, background, filters, steps)
+
+def render_stack(source: Image.Image, stack: FlatStack) -> Image.Image:
+    """The photo composited into the stack, RGBA; the reference fused_pipeline() is held to."""
+    source = apply_filters(source.convert("RGBA"), stack.filters)
+    if stack.background is not None:
+        composition = stack.background.copy()
+    else:
+        composition = Image.new("RGBA", source.size)
+    composition.alpha_composite(source)
+    for mode, opacity, layer in stack.steps:
+        if mode == BLEND_NORMAL:
+            composition.alpha_composite(layer)
+        else:
+            composition = blend(composition, layer, mode, opacity)
+    return composition
@@ -0,0 +1,60 @@
+"""POST recorded telegram updates to the local webhook.
+
+    python -m photobot.replay updates.json [more.json ...]
+
+A file holds one update, a JSON list of them (like the result of
+getUpdates) or one update per line. Run the bot with `telegram.mode:
+webhook` and `telegram.webhook_register: false`, so that telegram keeps
+delivering to wherever it did before.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from .config import Config
+
+def read_updates(filename: str) -> list[dict]:
+    with open(filename) as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(data, dict) and "result" in data:
+        data = data["result"]
+    return data if isinstance(data, list) else [data]
+
+async def replay(url: str, secret_token: str, updates: list[dict], delay: float) -> int:
+    client = AsyncHTTPClient()
+    failed = 0
+    for update in updates:
+        try:
+            await client.fetch(url, method="POST", body=json.dumps(update), headers={
+                "Content-Type": "application/json",
+                "X-Telegram-Bot-Api-Secret-Token": secret_token,
+            })
+            print(f"update {update.get('update_id')}: ok")
+        except HTTPClientError as e:
+            failed += 1
+            print(f"update {update.get('update_id')}: {e}")
+        if delay:
+            await asyncio.sleep(delay)
+    return failed
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--config", default="config/config.yaml")
+    parser.add_argument("--url", help="default http://localhost:<server.port><telegram.webhook_path>")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds between updates")
+    args = parser.parse_args(argv)
+
+    cfg = Config(args.config)
+    url = args.url or f"http://localhost:{cfg.server.port}{cfg.telegram.webhook_path}"
+    updates = [update for fn in args.files for update in read_updates(fn)]
+    failed = asyncio.run(replay(url, cfg.telegram.webhook_secret_token(), updates, args.delay))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SOURCE = "source"
+RESULT = "result"
+
+def _link(src: str, dst: str):
+    # files are only ever written under fresh names, so sharing the inode is safe
+    tmp = dst + ".part"
+    try:
+        os.link(src, tmp)
+    except FileExistsError:
+        os.remove(tmp)
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+class ResultCache(object):
+    """Disk-backed LRU of received photos and finished avatars.
+
+    Entries are addressed by telegram's file_unique_id, which is the same
+    for every copy of a photo, whoever sends it. Sources are keyed on it
+    alone, results also on the crop mode, the layer stack, the pipeline
+    version and the encoder. Files are hard linked in and out, so a hit costs no copy.
+    Entries are evicted least recently used first once the files take more
+    than `max_bytes`. The byte count is kept in this process only, so the
+    directory must not be shared with another instance.
+    """
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        # file name -> size, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = {SOURCE: 0, RESULT: 0}
+        self.misses = {SOURCE: 0, RESULT: 0}
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._scan()
+
+    def _scan(self):
+        files = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.name.endswith(".part"):
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        # hits touch the mtime, so it orders entries by last use across restarts
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.bytes += size
+        self._evict()
+        logger.info(f"result cache {self.path}: {len(self.entries)} entries, {self.bytes} bytes")
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()[:32]
+
+    def source_name(self, unique_id: str, ext: str) -> str:
+        return f"src_{self._digest(unique_id)}.{ext}"
+
+    def result_name(self, unique_id: str, mode: str, frame_digest: str, version: str, ext: str = "jpg") -> str:
+        return f"res_{self._digest(unique_id, mode, frame_digest, version)}.{ext}"
+
+    def _kind(self, name: str) -> str:
+        return SOURCE if name.startswith("src_") else RESULT
+
+    async def fetch(self, name: str, file_name: str) -> bool:
+        """Link the entry `name` to `file_name`, False on a miss."""
+        kind = self._kind(name)
+        if name in self.entries:
+            path = os.path.join(self.path, name)
+            try:
+                await asyncio.to_thread(_link, path, file_name)
+                os.utime(path)
+            except FileNotFoundError:
+                # removed behind our back
+                self._forget(name)
+            else:
+                self.entries.move_to_end(name)
+                self.hits[kind] += 1
+                return True
+        self.misses[kind] += 1
+        return False
+
+    async def put(self, name: str, file_name: str):
+        """Add `file_name` as the entry `name`, the file itself stays where it is."""
+        try:
+            size = os.path.getsize(file_name)
+            if size > self.max_bytes:
+                return
+            await asyncio.to_thread(_link, file_name, os.path.join(self.path, name))
+        except OSError as e:
+            logger.error(f"caching {file_name} as {name} failed: {e}")
+            return
+        self._forget(name)
+        self.entries[name] = size
+        self.bytes += size
+        self._evict()
+
+    def _forget(self, name: str):
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.bytes -= size
+
+    def _evict(self):
+        while self.bytes > self.max_bytes and self.entries:
+            name, size = self.entries.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def requests(self) -> dict:
+        """Hit and miss counts by entry kind, for the metrics."""
+        counts = dict()
+        for kind in (SOURCE, RESULT):
+            counts[f"{kind}_hit"] = self.hits[kind]
+            counts[f"{kind}_miss"] = self.misses[kind]
+        return counts
@@ -3,17 +3,162 @@ import tornado.web
 from tornado.httputil import HTTPServerRequest
 import tornado.platform.asyncio
 import os
-from .config import Config
-from .photo_task import get_by_uuid, real_frame_size
+from .config import Config, TELEGRAM_WEBHOOK
+from .photo_task import get_by_uuid, real_frame_size, CroppedUpload
+from .static_assets import StaticAssets, ENCODINGS
+from .admission import AdmissionError
+from . import metrics
+from telegram import Update
+from urllib.parse import unquote_to_bytes
 import base64
+import asyncio
+import hmac
 import json
+import mimetypes
+import re
+import struct
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# JPEG start of frame markers, they carry the image size
+JPEG_SOF = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# bytes of an upload buffered for sniff_image, canvas encoders write far smaller headers
+SNIFF_LIMIT = 64*1024
+# client reported encode times above this are not believed
+MAX_CLIENT_ENCODE = 10*60
+# upload format names of the web app, see photo.upload_formats
+CLIENT_FORMATS = ("webp", "webp-lossless", "jpeg", "png")
+
+def sniff_image(header: bytes) -> tuple[str, int, int]|None:
+    """(PIL format, width, height) from the first bytes of a PNG, WebP or JPEG file.
+
+    Returns None while more bytes are needed, raises ValueError for anything else.
+    """
+    if len(header) < 12:
+        if not (PNG_SIGNATURE.startswith(header[:8]) or b"RIFF".startswith(header[:4]) or b"\xff\xd8".startswith(header[:2])):
+            raise ValueError("upload is not a PNG, WebP or JPEG image")
+        return None
+    if header.startswith(PNG_SIGNATURE):
+        if len(header) < 24:
+            return None
+        if header[12:16] != b"IHDR":
+            raise ValueError("PNG without IHDR")
+        width, height = struct.unpack(">II", header[16:24])
+        return "PNG", width, height
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        if len(header) < 30:
+            return None
+        chunk = header[12:16]
+        if chunk == b"VP8 " and header[23:26] == b"\x9d\x01\x2a":
+            width, height = struct.unpack("<HH", header[26:30])
+            return "WEBP", width & 0x3fff, height & 0x3fff
+        if chunk == b"VP8L" and header[20] == 0x2f:
+            bits = int.from_bytes(header[21:25], "little")
+            return "WEBP", (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+        if chunk == b"VP8X":
+            return "WEBP", int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+        raise ValueError(f"unsupported WebP chunk {chunk!r}")
+    if header.startswith(b"\xff\xd8"):
+        # walk the marker segments up to the frame header
+        pos = 2
+        while pos + 4 <= len(header):
+            if header[pos] != 0xFF:
+                raise ValueError("broken JPEG marker")
+            marker = header[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            length = struct.unpack(">H", header[pos + 2:pos + 4])[0]
+            if marker in JPEG_SOF:
+                if pos + 9 > len(header):
+                    return None
+                height, width = struct.unpack(">HH", header[pos + 5:pos + 9])
+                return "JPEG", width, height
+            pos += 2 + length
+        return None
+    raise ValueError("upload is not a PNG, WebP or JPEG image")
+
+class Base64StreamDecoder(object):
+    """Decodes the base64 data URL inside a JSON or form body as it streams in.
+
+    Decoded bytes are passed to `sink`. Everything around the payload is collected in
+    `rest`, which stays a valid body of the same type with an empty image, so
+    the other fields can be parsed once the request is complete.
+    """
+    MARKER = re.compile(re.escape(b"base64,"))
+    URLENCODED_MARKER = re.compile(re.escape(b"base64%2c"), re.I)
+    PAYLOAD_END = re.compile(rb"[^A-Za-z0-9+/=]")
+    URLENCODED_PAYLOAD_END = re.compile(rb"[^A-Za-z0-9%]")
+
+    def __init__(self, sink, urlencoded: bool = False):
+        self.sink = sink
+        self.urlencoded = urlencoded
+        self.marker = self.URLENCODED_MARKER if urlencoded else self.MARKER
+        self.end = self.URLENCODED_PAYLOAD_END if urlencoded else self.PAYLOAD_END
+        self.rest = bytearray()
+        self.scanned = 0
+        self.found = False
+        self.done = False
+        self.escaped = b""
+        self.pending = b""
+
+    def feed(self, chunk: bytes):
+        if self.done:
+            self.rest += chunk
+            return
+        if not self.found:
+            self.rest += chunk
+            match = self.marker.search(self.rest, max(0, self.scanned - len(self.marker.pattern)))
+            self.scanned = len(self.rest)
+            if match is None:
+                return
+            chunk = bytes(self.rest[match.end():])
+            del self.rest[match.end():]
+            self.found = True
+        match = self.end.search(chunk)
+        if match is None:
+            self._payload(chunk)
+            return
+        self._payload(chunk[:match.start()])
+        self.rest += chunk[match.start():]
+        self.close()
+
+    def _payload(self, data: bytes):
+        if self.urlencoded:
+            # keep a %XX escape split between chunks for the next round
+            data = self.escaped + data
+            split = data.find(b"%", len(data) - 2)
+            if split >= 0:
+                data, self.escaped = data[:split], data[split:]
+            else:
+                self.escaped = b""
+            data = unquote_to_bytes(data)
+        data = self.pending + data
+        cut = len(data) - len(data) % 4
+        data, self.pending = data[:cut], data[cut:]
+        if data:
+            self.sink(base64.b64decode(data, validate=True))
+
+    def close(self):
+        if self.done:
+            return
+        self.done = True
+        if self.escaped or self.pending:
+            raise ValueError("truncated base64 payload")
+
+@tornado.web.stream_request_body
 class FitFrameHandler(tornado.web.RequestHandler):
     def initialize(self, app):
         self.app = app
+        self.upload = None
+        self.decoder = None
+        self.received = 0
+        self.header = b""
+        self.image_format = None
+        self.started = time.perf_counter()
 
     async def get(self):
         id_str = self.get_query_argument("id", default="")
@@ -23,20 +168,12 @@ class FitFrameHandler(tornado.web.RequestHandler):
 
         try:
             task = get_by_uuid(id_str)
+            await self.app.assets.refresh()
 
-            if self.app.users_collection is not None:
-                try:
-                    user_agent = self.request.headers.get("User-Agent")
-                    await self.app.users_collection.update_one({
-                        "user_id": task.user.id,
-                        "bot_id": self.app.bot.bot.id,
-                    }, {
-                        "$set": {
-                            "user_agent": user_agent
-                        },
-                    }, upsert=True)
-                except Exception as e:
-                    logger.error(f"mongodb update error: {e}", exc_info=1)
+            if self.app.stats is not None:
+                self.app.stats.update(task.user_id, self.app.bot.bot.id, set={
+                    "user_agent": self.request.headers.get("User-Agent"),
+                })
 
             self.render(
                 "fit_frame.html",
@@ -48,96 +185,286 @@ class FitFrameHandler(tornado.web.RequestHandler):
                 frame_mover_help_unified=localize("frame-mover-help-unified"),
                 finish_button_text=localize("frame-mover-finish-button-text"),
                 help_realign=localize("frame-realign-message"),
+                submission=self.app.config.photo.web_app_submission,
+                upload_formats=",".join(self.app.config.photo.upload_formats),
+                upload_quality=self.app.config.photo.upload_quality,
+                photo_size=task.get_file_size(),
+                assets=self.app.assets,
             )
         except (KeyError, ValueError):
             raise tornado.web.HTTPError(404)
 
+    def prepare(self):
+        if self.request.method != "POST":
+            return
+        max_size = self.app.config.server.max_upload_size
+        length = self.request.headers.get("Content-Length")
+        if length is not None and int(length) > max_size:
+            raise tornado.web.HTTPError(413)
+        self.request.connection.set_max_body_size(max_size)
+
+        content_type = self.request.headers.get('Content-Type','')
+        self.content_type = content_type
+        expected = int(length) if length is not None else None
+        if 'application/json' in content_type or 'multipart/form-data' in content_type:
+            self.decoder = Base64StreamDecoder(self.image_received)
+        elif 'application/x-www-form-urlencoded' in content_type:
+            self.decoder = Base64StreamDecoder(self.image_received, urlencoded=True)
+        if expected is not None and self.decoder is not None:
+            expected = expected * 3 // 4
+        self.upload = CroppedUpload(expected)
+
+    def data_received(self, chunk: bytes):
+        if self._finished:
+            return
+        try:
+            self.received += len(chunk)
+            if self.received > self.app.config.server.max_upload_size:
+                raise tornado.web.HTTPError(413)
+            if self.decoder is not None:
+                self.decoder.feed(chunk)
+            else:
+                self.image_received(chunk)
+        except Exception as e:
+            if not isinstance(e, tornado.web.HTTPError):
+                logger.error("bad upload request", exc_info=1)
+                e = tornado.web.HTTPError(400)
+            self.upload.abort()
+            # finishing before the body is read makes tornado drop the rest and close the connection
+            self.send_error(e.status_code)
+
+    def image_received(self, chunk: bytes):
+        """Image bytes from the body: the format and size are sniffed from the header, then stored."""
+        if self.image_format is None:
+            self.header += chunk[:SNIFF_LIMIT - len(self.header)]
+            sniffed = sniff_image(self.header)
+            if sniffed is None and len(self.header) >= SNIFF_LIMIT:
+                raise ValueError(f"no image size in the first {SNIFF_LIMIT} bytes")
+            if sniffed is not None:
+                fmt, width, height = sniffed
+                if (width, height) != (real_frame_size, real_frame_size):
+                    raise ValueError(f"unexpected {fmt} upload size {width}x{height}")
+                self.image_format = self.upload.format = fmt
+                self.header = b""
+        self.upload.write(chunk)
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        if self.upload is not None:
+            self.upload.abort()
+
     async def post(self):
-        """Accept cropped PNG (data URL or raw bytes) from canvas and store as cropped file.
+        """Accept cropped PNG, WebP or JPEG (data URL or raw bytes) from canvas and store as cropped file.
         Body formats supported:
-        - JSON { id: <uuid>, image: 'data:image/png;base64,...' }
+        - JSON { id: <uuid>, image: 'data:image/webp;base64,...' }
         - form-data / x-www-form-urlencoded with fields id, image
         - raw binary with query param ?id=...
+        The image format is sniffed from the content, whatever the declared type.
+        The body is processed as it arrives, base64 payloads are decoded on the fly.
+        An optional ?encode_ms= query parameter reports the client's encode time.
         Returns JSON {status:"ok"} or error.
         """
+        if self._finished:
+            return
         try:
-            content_type = self.request.headers.get('Content-Type','')
-            if content_type.startswith('image/png'):
-                # Raw binary with ?id= param
-                id_str = self.get_query_argument('id','')
-                image_data = self.request.body
-            elif 'application/json' in content_type:
-                payload = json.loads(self.request.body.decode('utf-8'))
-                id_str = payload.get('id','')
-                image_data = payload.get('image','')
-            elif 'application/x-www-form-urlencoded' in content_type or 'multipart/form-data' in content_type:
-                id_str = self.get_body_argument('id','')
-                image_data = self.get_body_argument('image','')
-            else:
-                # Fallback treat as raw binary
-                id_str = self.get_query_argument('id','')
-                image_data = self.request.body
+            id_str = self.get_query_argument('id','')
+            if self.decoder is not None:
+                self.decoder.close()
+                body = bytes(self.decoder.rest)
+                if 'application/json' in self.content_type:
+                    payload = json.loads(body.decode('utf-8'))
+                    id_str = payload.get('id', id_str)
+                    image_data = payload.get('image','')
+                else:
+                    arguments = dict()
+                    tornado.httputil.parse_body_arguments(self.content_type, body, arguments, dict())
+                    if 'id' in arguments:
+                        id_str = arguments['id'][0].decode('utf-8')
+                    image_data = arguments.get('image', [b''])[0].decode('utf-8')
+                if not self.decoder.found:
+                    # plain base64 without the data URL header
+                    self.image_received(base64.b64decode(image_data))
+            if self.image_format is None:
+                raise ValueError("upload is too short")
             task = get_by_uuid(id_str)
         except Exception:
             logger.error("bad upload request", exc_info=1)
+            self.upload.abort()
             raise tornado.web.HTTPError(400)
 
-        # Expect a data URL or bytes
-        binary: bytes
-        if isinstance(image_data, str):
-            if image_data.startswith('data:image'):
-                try:
-                    header, b64data = image_data.split(',',1)
-                    binary = base64.b64decode(b64data)
-                except Exception:
-                    raise tornado.web.HTTPError(400)
-            else:
-                # assume base64 without header
-                try:
-                    binary = base64.b64decode(image_data)
-                except Exception:
-                    raise tornado.web.HTTPError(400)
-        else:
-            binary = image_data
-
         try:
-            task.set_cropped_file_from_upload(binary)
+            task.set_cropped_from_upload(self.upload)
         except Exception as e:
             logger.error("error writing uploaded cropped image: %s", e, exc_info=1)
+            self.upload.abort()
             raise tornado.web.HTTPError(500)
+        metrics.stages.observe("upload", time.perf_counter() - self.started)
+        # the client's name tells lossless WebP apart, as long as it agrees with the bytes
+        fmt = self.get_query_argument("format", "")
+        if fmt not in CLIENT_FORMATS or fmt.split("-")[0] != self.image_format.lower():
+            fmt = self.image_format.lower()
+        metrics.upload_bytes.observe(fmt, self.upload.nbytes)
+        try:
+            encode_seconds = float(self.get_query_argument("encode_ms", "")) / 1000
+            if 0 <= encode_seconds <= MAX_CLIENT_ENCODE:
+                metrics.client_encode_seconds.observe(fmt, encode_seconds)
+        except ValueError:
+            pass
+        self.upload = None
         self.set_header('Content-Type','application/json')
         self.write({'status':'ok'})
 
 
 
 class PhotoHandler(tornado.web.StaticFileHandler):
+    """Original photo of a task, or with ?max=<px>&fmt=webp|jpeg a downscaled rendition of it."""
+    CACHE_TIME = 24*60*60
+
     def __init__(self, application: tornado.web.Application, request: HTTPServerRequest, **kwargs: Any) -> None:
         super().__init__(application, request, path="", **kwargs)
-    
-    @classmethod
-    def get_absolute_path(cls, root: str, path: str) -> str:
+        self.file_path = ""
+
+    async def get(self, path: str, include_body: bool = True) -> None:
         try:
             task = get_by_uuid(path)
-            if task.file is None:
-                return ""
-            return task.file
         except (KeyError, ValueError):
-            return ""
-    
+            raise tornado.web.HTTPError(404)
+        if task.file is None:
+            raise tornado.web.HTTPError(404)
+        self.file_path = task.file
+
+        max_side = self.get_query_argument("max", None)
+        if max_side is not None:
+            try:
+                self.file_path = await task.get_preview(int(max_side), self.get_query_argument("fmt", "jpeg"))
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            except AdmissionError:
+                # the page falls back to the original
+                self.set_status(503)
+                self.set_header("Retry-After", "5")
+                self.finish()
+                return
+        await super().get(path, include_body)
+
+    def parse_url_path(self, url_path: str) -> str:
+        return self.file_path
+
+    @classmethod
+    def get_absolute_path(cls, root: str, path: str) -> str:
+        return path
+
     def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
         if absolute_path == "" or not os.path.isfile(absolute_path):
             raise tornado.web.HTTPError(404)
         return absolute_path
 
+    def get_cache_time(self, path: str, modified, mime_type: str) -> int:
+        # a task never changes its photo, and the id is not reused
+        return self.CACHE_TIME
+
+    def set_extra_headers(self, path: str) -> None:
+        self.set_header("Cache-Control", f"private, max-age={self.CACHE_TIME}")
+
+
+def accepted_encodings(header: str) -> set[str]:
+    """Content codings of an Accept-Encoding header, without the refused (q=0) ones."""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if params and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+class AssetHandler(tornado.web.StaticFileHandler):
+    """Built web app assets, see StaticAssets: cached for good, precompressed when the client takes it."""
+    CACHE_TIME = 365*24*60*60
 
+    def initialize(self, path: str):
+        super().initialize(path)
+        self.encoding = None
+
+    def parse_url_path(self, url_path: str) -> str:
+        path = super().parse_url_path(url_path)
+        accepted = accepted_encodings(self.request.headers.get("Accept-Encoding", ""))
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(os.path.join(self.root, path + suffix)):
+                self.encoding = encoding
+                return path + suffix
+        return path
+
+    def get_content_type(self) -> str:
+        if self.encoding is None:
+            return super().get_content_type()
+        # the type of the file before compression
+        mime_type, _ = mimetypes.guess_type(os.path.splitext(self.absolute_path)[0])
+        return mime_type or "application/octet-stream"
+
+    def get_cache_time(self, path: str, modified, mime_type: str) -> int:
+        # names change with the content
+        return self.CACHE_TIME
+
+    def set_extra_headers(self, path: str) -> None:
+        self.set_header("Cache-Control", f"public, max-age={self.CACHE_TIME}, immutable")
+        self.set_header("Vary", "Accept-Encoding")
+        if self.encoding is not None:
+            self.set_header("Content-Encoding", self.encoding)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Prometheus text exposition of photobot.metrics."""
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    """Feeds updates POSTed by telegram into the bot's update queue."""
+    SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+    def initialize(self, app, secret_token: str):
+        self.app = app
+        self.secret_token = secret_token.encode()
+
+    async def post(self):
+        token = self.request.headers.get(self.SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(token, self.secret_token):
+            logger.warning(f"webhook request from {self.request.remote_ip} with a wrong secret token")
+            raise tornado.web.HTTPError(403)
+        bot = self.app.bot
+        if bot is None:
+            # not started yet or shutting down, telegram retries
+            raise tornado.web.HTTPError(503)
+        try:
+            update = Update.de_json(json.loads(self.request.body), bot.bot)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warning(f"malformed webhook update: {e}")
+            raise tornado.web.HTTPError(400)
+        # answer right away, handlers run on the application's own loop
+        await bot.update_queue.put(update)
+        self.set_status(200)
 
 async def create_server(config: Config, base_app):
     tornado.platform.asyncio.AsyncIOMainLoop().install()
-    app = tornado.web.Application([
+    base_app.assets = StaticAssets("static/", config.server.assets_path, config.photo.layers_file, config.server.frame_sizes)
+    await asyncio.to_thread(base_app.assets.build)
+    handlers = [
         (r"/fit_frame", FitFrameHandler, {"app": base_app}),
         (r"/photos/(.*)", PhotoHandler),
+        (r"/assets/(.*)", AssetHandler, {"path": config.server.assets_path}),
         (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": "static/"}),
-    ], template_path="templates/")
+    ]
+    if config.server.metrics:
+        handlers.append((r"/metrics", MetricsHandler))
+    if config.telegram.mode == TELEGRAM_WEBHOOK:
+        handlers.append((re.escape(config.telegram.webhook_path), TelegramWebhookHandler, {
+            "app": base_app,
+            "secret_token": config.telegram.webhook_secret_token(),
+        }))
+    app = tornado.web.Application(handlers, template_path="templates/")
     app.listen(config.server.port)
     base_app.server = app
 
@@ -0,0 +1,175 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import re
+import logging
+import PIL.Image as Image
+from .frame_asset import FrameAsset, stack_digest
+from .pipeline.layers import with_opacity
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# files of the static directory served under fingerprinted names
+SOURCES = ("fit_frame.mjs", "fit_frame.css")
+# images are compressed already, text is precompressed
+COMPRESSIBLE = (".mjs", ".js", ".css", ".svg")
+# (Accept-Encoding token, file suffix), preferred first
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+# frame rendition writers, the page offers them in this order
+FRAME_FORMATS = {
+    "webp": {"format": "WEBP", "quality": 90, "method": 4},
+    "png": {"format": "PNG", "optimize": True},
+}
+# bump when the renditions change for the same inputs
+BUILD_VERSION = "1"
+# names build() writes, the only files it removes
+BUILT_FILE = re.compile(
+    r"^(?:" + "|".join(re.escape(os.path.splitext(name)[0]) for name in SOURCES) + r"|frame-\d+)"
+    r"\.[0-9a-f]{16}\.\w+(?:\.gz|\.br)?(?:\.part)?$"
+)
+
+def _digest(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+def fingerprinted(name: str, digest: str) -> str:
+    base, ext = os.path.splitext(name)
+    return f"{base}.{digest}{ext}"
+
+def _write(file_name: str, data: bytes):
+    tmp = file_name + ".part"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, file_name)
+
+def frame_preview(asset: FrameAsset, size: int) -> Image.Image:
+    """What the web app draws over the photo: the layers above it, other blend modes shown as normal."""
+    stack = asset.get(size)
+    preview = Image.new("RGBA", (size, size))
+    for _, opacity, layer in stack.steps:
+        preview.alpha_composite(with_opacity(layer, opacity))
+    return preview
+
+class StaticAssets(object):
+    """Web app files under content-hashed names, see AssetHandler for serving them.
+
+    build() writes the SOURCES of `source` to `path` as <name>.<hash>.<ext>
+    with .gz (and .br, given the brotli module) variants next to them, and
+    renders the frame of the layer stack at every size of `frame_sizes`.
+    Outputs that already exist are kept, older builds in `path` are removed,
+    other files there are left alone.
+    """
+    def __init__(self, source: str, path: str, layers_file: str, frame_sizes: list[int]):
+        self.source = source
+        self.path = path
+        self.layers_file = layers_file
+        self.frame_sizes = sorted(frame_sizes)
+        # source name -> built file name
+        self.files = dict()
+        # format -> [(size, built file name)], smallest first
+        self.frames = dict()
+        self._inputs = None
+        self._lock = asyncio.Lock()
+
+    def _stat(self) -> tuple|None:
+        try:
+            mtimes = tuple(os.stat(os.path.join(self.source, name)).st_mtime_ns for name in SOURCES)
+            return mtimes + (stack_digest(self.layers_file),)
+        except (OSError, ValueError):
+            # a broken edit, the last build stays
+            return None
+
+    def stale(self) -> bool:
+        inputs = self._stat()
+        return inputs is not None and inputs != self._inputs
+
+    def _add(self, name: str, data: bytes, keep: set):
+        keep.add(name)
+        file_name = os.path.join(self.path, name)
+        if os.path.exists(file_name):
+            keep.update(name + suffix for _, suffix in ENCODINGS if os.path.exists(file_name + suffix))
+            return
+        if name.endswith(COMPRESSIBLE):
+            variants = {".gz": gzip.compress(data, 9, mtime=0)}
+            if brotli is not None:
+                variants[".br"] = brotli.compress(data, quality=11)
+            for suffix, compressed in variants.items():
+                # tiny files may grow
+                if len(compressed) < len(data):
+                    _write(file_name + suffix, compressed)
+                    keep.add(name + suffix)
+        # written last, its presence marks the set complete
+        _write(file_name, data)
+
+    def build(self):
+        os.makedirs(self.path, exist_ok=True)
+        inputs = self._stat()
+        if inputs is None:
+            raise ValueError(f"web app assets of {self.source} and {self.layers_file} are not readable")
+        keep = set()
+        files = dict()
+        for name in SOURCES:
+            with open(os.path.join(self.source, name), "rb") as f:
+                data = f.read()
+            files[name] = fingerprinted(name, _digest(data))
+            self._add(files[name], data, keep)
+
+        frames = dict()
+        asset = None
+        for size in self.frame_sizes:
+            for ext, args in FRAME_FORMATS.items():
+                # named by the inputs, so a restart finds the renditions without rendering them
+                name = fingerprinted(f"frame-{size}.{ext}", _digest(BUILD_VERSION, inputs[-1], size, sorted(args.items())))
+                frames.setdefault(ext, []).append((size, name))
+                keep.add(name)
+                file_name = os.path.join(self.path, name)
+                if os.path.exists(file_name):
+                    continue
+                if asset is None:
+                    asset = FrameAsset(self.layers_file, self.frame_sizes)
+                frame_preview(asset, size).save(file_name + ".part", **args)
+                os.replace(file_name + ".part", file_name)
+
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name not in keep and BUILT_FILE.match(entry.name):
+                    os.remove(entry.path)
+        self.files = files
+        self.frames = frames
+        self._inputs = inputs
+        total = sum(os.path.getsize(os.path.join(self.path, name)) for name in keep)
+        logger.info(f"web app assets built in {self.path}: {len(keep)} files, {total} bytes, brotli {brotli is not None}")
+
+    async def refresh(self):
+        """Rebuild when a source or the layer stack changed, concurrent callers wait for the same build."""
+        if not self.stale():
+            return
+        async with self._lock:
+            if not self.stale():
+                return
+            inputs = self._stat()
+            try:
+                await asyncio.to_thread(self.build)
+            except Exception as e:
+                self._inputs = inputs
+                logger.error(f"rebuilding web app assets failed, keeping the last build: {e}")
+
+    def url(self, name: str) -> str:
+        """Relative URL of the built source `name`."""
+        return f"assets/{self.files[name]}"
+
+    def frame_srcset(self, ext: str) -> str:
+        return ", ".join(f"assets/{name} {size}w" for size, name in self.frames[ext])
+
+    def frame_url(self, ext: str) -> str:
+        """The smallest rendition, for clients ignoring srcset."""
+        return f"assets/{self.frames[ext][0][1]}"
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+from pymongo import UpdateOne
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+class StatsSink(object):
+    """Write-behind queue for the per-user statistics upserts.
+
+    Updates are merged per (user_id, bot_id): `$inc` counters are summed,
+    the last `$set` value of a field wins and the first `$setOnInsert` one
+    is kept. Pending documents are written with one unordered bulk_write
+    once `flush_size` of them are queued or every `flush_interval` seconds.
+    At most `max_pending` documents are queued, updates for further users
+    are dropped and counted. `collection` only needs an async bulk_write.
+    """
+    def __init__(self, collection, flush_size: int = 500, flush_interval: float = 5.0, max_pending: int = 10000):
+        self.collection = collection
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = dict()
+        self.dropped = 0
+        self.failed = 0
+        self.written = 0
+        self._wakeup = asyncio.Event()
+        self._runner = None
+        self._closing = False
+
+    def update(self, user_id: int, bot_id: int, set: dict|None = None, inc: dict|None = None,
+               set_on_insert: dict|None = None, upsert: bool = True):
+        key = (user_id, bot_id)
+        entry = self.pending.get(key)
+        if entry is None:
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            entry = {"$set": dict(), "$inc": dict(), "$setOnInsert": dict(), "upsert": False}
+            self.pending[key] = entry
+        if set:
+            entry["$set"].update(set)
+        if inc:
+            for field, value in inc.items():
+                entry["$inc"][field] = entry["$inc"].get(field, 0) + value
+        if set_on_insert:
+            for field, value in set_on_insert.items():
+                entry["$setOnInsert"].setdefault(field, value)
+        entry["upsert"] = entry["upsert"] or upsert
+        if len(self.pending) >= self.flush_size:
+            self._wakeup.set()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, dict()
+        requests = []
+        for (user_id, bot_id), entry in pending.items():
+            upsert = entry.pop("upsert")
+            requests.append(UpdateOne(
+                {"user_id": user_id, "bot_id": bot_id},
+                {op: fields for op, fields in entry.items() if fields},
+                upsert=upsert,
+            ))
+        try:
+            with metrics.timed("mongo_write"):
+                await self.collection.bulk_write(requests, ordered=False)
+            self.written += len(requests)
+        except Exception as e:
+            self.failed += len(requests)
+            logger.error(f"mongodb bulk update of {len(requests)} users failed: {e}", exc_info=1)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        self._runner = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the flush loop and write what is still queued."""
+        # let a bulk_write in flight finish instead of cancelling it
+        self._closing = True
+        self._wakeup.set()
+        if self._runner is not None:
+            await self._runner
+            self._runner = None
+        await self.flush()
+        logger.info(f"stats sink closed: {self.written} written, {self.failed} failed, {self.dropped} dropped")
@@ -0,0 +1,223 @@
+import os
+import uuid
+import heapq
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+TASK_STORE_MEMORY = "memory"
+TASK_STORE_SQLITE = "sqlite"
+TASK_STORES = (TASK_STORE_MEMORY, TASK_STORE_SQLITE)
+
+# PhotoTask attributes kept by persistent stores
+TASK_FIELDS = ("id", "chat_id", "user_id", "start_date", "file", "cropped_file", "final_file", "debug_code", "source_id")
+
+class TaskStore(object):
+    """Holds PhotoTask records with lookups by uuid, user and chat.
+
+    Lookups raise KeyError for unknown tasks. A user and a chat have at most
+    one task each, adding a task replaces the index entries of older ones.
+    """
+    persistent = False
+
+    def add(self, task):
+        raise NotImplementedError()
+
+    def save(self, task):
+        """Called after the task changed its files or debug code."""
+        pass
+
+    def remove(self, task):
+        raise NotImplementedError()
+
+    def get_by_uuid(self, id: uuid.UUID):
+        raise NotImplementedError()
+
+    def get_by_user(self, id: int):
+        raise NotImplementedError()
+
+    def get_by_chat(self, id: int):
+        raise NotImplementedError()
+
+    def load(self) -> list:
+        """Tasks left over from a previous run."""
+        return []
+
+    def count(self) -> int:
+        raise NotImplementedError()
+
+    def oldest(self) -> float|None:
+        """Earliest start_date of the stored tasks."""
+        raise NotImplementedError()
+
+    def expired(self, started_before: float, limit: int) -> list:
+        """Up to `limit` tasks started before `started_before`, oldest first, for the caller to remove."""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class MemoryTaskStore(TaskStore):
+    """Tasks of this process only, lost on restart."""
+    def __init__(self):
+        self.by_uuid = dict()
+        self.by_user = dict()
+        self.by_chat = dict()
+        # (start_date, id) of added tasks, entries of removed tasks are skipped lazily
+        self.by_start = []
+
+    def _index(self, task):
+        self.by_uuid[task.id] = task
+        self.by_user[task.user_id] = task
+        self.by_chat[task.chat_id] = task
+
+    def add(self, task):
+        self._index(task)
+        heapq.heappush(self.by_start, (task.start_date, task.id))
+
+    def remove(self, task):
+        self.by_uuid.pop(task.id, None)
+        if self.by_user.get(task.user_id) is task:
+            del self.by_user[task.user_id]
+        if self.by_chat.get(task.chat_id) is task:
+            del self.by_chat[task.chat_id]
+
+    def get_by_uuid(self, id: uuid.UUID):
+        return self.by_uuid[id]
+
+    def get_by_user(self, id: int):
+        return self.by_user[id]
+
+    def get_by_chat(self, id: int):
+        return self.by_chat[id]
+
+    def _drop_stale(self):
+        while self.by_start and self.by_start[0][1] not in self.by_uuid:
+            heapq.heappop(self.by_start)
+
+    def count(self) -> int:
+        return len(self.by_uuid)
+
+    def oldest(self) -> float|None:
+        self._drop_stale()
+        return self.by_start[0][0] if self.by_start else None
+
+    def expired(self, started_before: float, limit: int) -> list:
+        tasks = []
+        while self.by_start and len(tasks) < limit and self.by_start[0][0] < started_before:
+            _, id = heapq.heappop(self.by_start)
+            task = self.by_uuid.get(id)
+            if task is not None:
+                tasks.append(task)
+        return tasks
+
+class SQLiteTaskStore(MemoryTaskStore):
+    """Task metadata and file paths in a local SQLite file, so tasks survive restarts.
+
+    The file belongs to one bot process: conversation states are kept in
+    that process's memory and its persistence file, so a second process on
+    the same storage_path would not see them. Rows are the source of truth,
+    task objects are cached so that state which only lives in memory
+    (cropped stages, pending previews) is kept, and their file fields are
+    refreshed from the row on every lookup.
+    `restore` builds a task object from a row dict, `task.refresh(row)` updates one.
+    """
+    persistent = True
+
+    def __init__(self, path: str, restore):
+        super().__init__()
+        self.path = path
+        self.restore = restore
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # autocommit, every statement is its own short transaction
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=10)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "id TEXT PRIMARY KEY, chat_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+            "start_date REAL NOT NULL, file TEXT, cropped_file TEXT, final_file TEXT, debug_code TEXT, source_id TEXT)"
+        )
+        columns = {row["name"] for row in self.db.execute("PRAGMA table_info(tasks)")}
+        for field in TASK_FIELDS:
+            if field not in columns:
+                # files of older versions, the added fields are nullable text
+                self.db.execute(f"ALTER TABLE tasks ADD COLUMN {field} TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_user ON tasks (user_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_chat ON tasks (chat_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS tasks_start ON tasks (start_date)")
+        logger.info(f"task store: sqlite {path}")
+
+    def _row(self, task) -> tuple:
+        return (task.id.hex,) + tuple(getattr(task, field) for field in TASK_FIELDS[1:])
+
+    def add(self, task):
+        self.db.execute(
+            "DELETE FROM tasks WHERE (user_id = ? OR chat_id = ?) AND id != ?",
+            (task.user_id, task.chat_id, task.id.hex),
+        )
+        self.db.execute(
+            f"INSERT OR REPLACE INTO tasks ({', '.join(TASK_FIELDS)}) VALUES ({', '.join('?' * len(TASK_FIELDS))})",
+            self._row(task),
+        )
+        # expiry order comes from the table, by_start stays unused
+        self._index(task)
+
+    def save(self, task):
+        self.db.execute(
+            f"UPDATE tasks SET {', '.join(f'{field} = ?' for field in TASK_FIELDS[1:])} WHERE id = ?",
+            self._row(task)[1:] + (task.id.hex,),
+        )
+
+    def remove(self, task):
+        self.db.execute("DELETE FROM tasks WHERE id = ?", (task.id.hex,))
+        super().remove(task)
+
+    def _task(self, row: sqlite3.Row|None):
+        if row is None:
+            raise KeyError()
+        record = dict(row)
+        record["id"] = uuid.UUID(record["id"])
+        task = self.by_uuid.get(record["id"])
+        if task is None:
+            task = self.restore(record)
+            self._index(task)
+        else:
+            # the row may have been edited behind our back
+            task.refresh(record)
+        return task
+
+    def get_by_uuid(self, id: uuid.UUID):
+        row = self.db.execute("SELECT * FROM tasks WHERE id = ?", (id.hex,)).fetchone()
+        if row is None and id in self.by_uuid:
+            # the row is gone, drop the cached task too
+            super().remove(self.by_uuid[id])
+        return self._task(row)
+
+    def get_by_user(self, id: int):
+        return self._task(self.db.execute("SELECT * FROM tasks WHERE user_id = ?", (id,)).fetchone())
+
+    def get_by_chat(self, id: int):
+        return self._task(self.db.execute("SELECT * FROM tasks WHERE chat_id = ?", (id,)).fetchone())
+
+    def load(self) -> list:
+        return [self._task(row) for row in self.db.execute("SELECT * FROM tasks").fetchall()]
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
+
+    def oldest(self) -> float|None:
+        return self.db.execute("SELECT MIN(start_date) FROM tasks").fetchone()[0]
+
+    def expired(self, started_before: float, limit: int) -> list:
+        rows = self.db.execute(
+            "SELECT * FROM tasks WHERE start_date < ? ORDER BY start_date LIMIT ?", (started_before, limit)
+        ).fetchall()
+        return [self._task(row) for row in rows]
+
+    def close(self):
+        self.db.close()
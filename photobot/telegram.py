@@ -1,10 +1,11 @@
 from contextlib import asynccontextmanager
 import json
+import math
 import re
 import os
 import mimetypes
-import tempfile
-from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, WebAppInfo
+import asyncio
+from telegram import Update, PhotoSize, ReplyKeyboardMarkup, ReplyKeyboardRemove, KeyboardButton, WebAppInfo
 from telegram.ext import (
     CallbackContext,
     ApplicationBuilder,
@@ -13,10 +14,15 @@ from telegram.ext import (
     ConversationHandler,
     filters,
     Application,
+    PicklePersistence,
+    PersistenceInput,
 )
 import logging
-from .photo_task import get_by_user, PhotoTask
-from .config import Config
+from .photo_task import get_by_user, PhotoTask, real_frame_size, transform_mode, AUTOCROP_MODE
+from .admission import AdmissionError, UserBusy
+from . import metrics
+from .task_store import TASK_STORE_MEMORY
+from .config import Config, TELEGRAM_POLLING, TELEGRAM_WEBHOOK
 import datetime
 
 logger = logging.getLogger(__name__)
@@ -38,97 +44,120 @@ def full_link(app: "TGApplication", link: str) -> str:
             link = re.sub(r"http://(([a-z]+)\.)?localhost(:\d+)?/", f"https://complynx.net/testbot/{host}/", link)
     return link
 
+def _stats(context: CallbackContext):
+    """Queued user statistics, None when no users db is configured."""
+    return context.application.base_app.stats
+
 def _localize(update: Update, context: CallbackContext):
-    return lambda key: context.application.base_app.localization(key, locale=update.effective_user.language_code)
+    return lambda key, args=None: context.application.base_app.localization(key, args, locale=update.effective_user.language_code)
+
+def _queue_notifier(update: Update, context: CallbackContext):
+    """Tells the user where their image job is in the admission queue."""
+    loc = _localize(update, context)
+    async def notify(position: int):
+        await update.message.reply_text(loc("processing-queued", {"position": position}))
+    return notify
 
 async def start(update: Update, context: CallbackContext):
     """Send a welcome message when the /start command is issued."""
     logger.info(f"start called: {update.effective_user}")
     loc = _localize(update, context)
 
-    if context.application.base_app.users_collection is not None:
-        try:
-            await context.application.base_app.users_collection.update_one({
-                "user_id": update.effective_user.id,
-                "bot_id": context.bot.id,
-            }, {
-                "$set": {
-                    "username": update.effective_user.username,
-                    "first_name": update.effective_user.first_name,
-                    "last_name": update.effective_user.last_name,
-                    "language_code": update.effective_user.language_code,
-                },
-                "$inc": {
-                    "starts_called": 1,
-                },
-                "$setOnInsert": {
-                    "user_id": update.effective_user.id,
-                    "bot_id": context.bot.id,
-                    "bot_username": context.bot.username,
-                    "first_seen": datetime.datetime.now(),
-                }
-            }, upsert=True)
-        except Exception as e:
-            logger.error(f"mongodb update error: {e}", exc_info=1)
+    if _stats(context) is not None:
+        _stats(context).update(
+            update.effective_user.id,
+            context.bot.id,
+            set={
+                "username": update.effective_user.username,
+                "first_name": update.effective_user.first_name,
+                "last_name": update.effective_user.last_name,
+                "language_code": update.effective_user.language_code,
+            },
+            inc={
+                "starts_called": 1,
+            },
+            set_on_insert={
+                "bot_username": context.bot.username,
+                "first_seen": datetime.datetime.now(),
+            },
+        )
 
     await update.message.reply_html(loc("start-message"))
 
+def select_photo_size(sizes: list[PhotoSize], margin: float) -> PhotoSize:
+    """Smallest rendition whose short side covers the working frame with the margin, else the largest."""
+    needed = real_frame_size * margin
+    largest = max(sizes, key=lambda size: size.width * size.height)
+    sufficient = [size for size in sizes if min(size.width, size.height) >= needed]
+    if not sufficient:
+        return largest
+    selected = min(sufficient, key=lambda size: size.width * size.height)
+    if selected is not largest and selected.file_size and largest.file_size:
+        logger.info(
+            f"using {selected.width}x{selected.height} photo instead of {largest.width}x{largest.height}, "
+            f"{largest.file_size - selected.file_size} bytes saved"
+        )
+    return selected
+
 async def avatar_received_image(update: Update, context: CallbackContext):
     """Handle the photo submission as photo"""
     logger.info(f"Received avatar photo from {update.effective_user}")
 
-    photo_file = await update.message.photo[-1].get_file()
-    file_name = f"{photo_file.file_id}.jpg"
-    file_path = os.path.join(tempfile.gettempdir(), file_name)
-    
-    await photo_file.download_to_drive(file_path)
-    return await avatar_received_stage2(update, context, file_path, "jpg")
+    conf: Config = context.application.config
+    photo = select_photo_size(update.message.photo, conf.photo.photo_size_margin)
+    return await avatar_received_stage2(update, context, photo, "jpg")
 
 async def avatar_received_document_image(update: Update, context: CallbackContext):
     """Handle the photo submission as document"""
     logger.info(f"Received avatar document from {update.effective_user}")
 
     document = update.message.document
+    file_ext = (mimetypes.guess_extension(document.mime_type) or ".img").lstrip(".")
+    return await avatar_received_stage2(update, context, document, file_ext)
 
-    # Download the document
-    document_file = await document.get_file()
-    file_ext = mimetypes.guess_extension(document.mime_type)
-    file_path = os.path.join(tempfile.gettempdir(), f"{document.file_id}.{file_ext}")
-    await document_file.download_to_drive(file_path)
-    return await avatar_received_stage2(update, context, file_path, file_ext)
+async def download_media(task: PhotoTask, media, file_ext: str):
+    # a photo sent before is taken from the result cache, without even asking for the file
+    if await task.file_from_cache(media.file_unique_id, file_ext):
+        return
+    with metrics.timed("download"):
+        tg_file = await media.get_file()
+        await task.download_file(tg_file, file_ext, media.file_size)
+    await task.cache_file(file_ext)
 
-async def avatar_received_stage2(update: Update, context: CallbackContext, file_path:str, file_ext:str):
+async def avatar_received_stage2(update: Update, context: CallbackContext, media, file_ext:str):
     await avatar_cancel_inner(update, context)
     loc = _localize(update, context)
 
-    if context.application.base_app.users_collection is not None:
-        try:
-            await context.application.base_app.users_collection.update_one({
-                "user_id": update.effective_user.id,
-                "bot_id": context.bot.id,
-            }, {
-                "$set": {
-                    "username": update.effective_user.username,
-                    "first_name": update.effective_user.first_name,
-                    "last_name": update.effective_user.last_name,
-                    "language_code": update.effective_user.language_code,
-                    "last_avatar_call": datetime.datetime.now(),
-                },
-                "$inc": {
-                    "avatars_called": 1,
-                },
-                "$setOnInsert": {
-                    "user_id": update.effective_user.id,
-                    "bot_id": context.bot.id,
-                    "bot_username": context.bot.username,
-                    "first_seen": datetime.datetime.now(),
-                }
-            }, upsert=True)
-        except Exception as e:
-            logger.error(f"mongodb update error: {e}", exc_info=1)
+    # the photo goes straight into the new task's storage while the bookkeeping runs
+    task = PhotoTask(update.effective_chat.id, update.effective_user.id)
+    download = asyncio.create_task(download_media(task, media, file_ext))
+    metrics.conversations.inc("created")
+
+    if _stats(context) is not None:
+        _stats(context).update(
+            update.effective_user.id,
+            context.bot.id,
+            set={
+                "username": update.effective_user.username,
+                "first_name": update.effective_user.first_name,
+                "last_name": update.effective_user.last_name,
+                "language_code": update.effective_user.language_code,
+                "last_avatar_call": datetime.datetime.now(),
+            },
+            inc={
+                "avatars_called": 1,
+            },
+            set_on_insert={
+                "bot_username": context.bot.username,
+                "first_seen": datetime.datetime.now(),
+            },
+        )
 
-    task = PhotoTask(update.effective_chat, update.effective_user)
-    task.add_file(file_path, file_ext)
+    try:
+        await download
+    except Exception as e:
+        logger.error("Exception downloading avatar: %s", e, exc_info=1)
+        return await avatar_error(update, context)
     buttons = [
         [
             KeyboardButton(
@@ -160,9 +189,13 @@ async def avatar_crop_auto(update: Update, context: CallbackContext):
         logger.error("Exception in autocrop: %s", e, exc_info=1)
         return await avatar_error(update, context)
     await update.message.reply_text(loc("processing-photo"), reply_markup=ReplyKeyboardRemove())
-    
+    if await task.final_from_cache(AUTOCROP_MODE):
+        return await avatar_crop_stage2(task, update, context)
+
     try:
-        await task.resize_avatar()
+        await task.resize_avatar(on_queued=_queue_notifier(update, context))
+    except AdmissionError as e:
+        return await avatar_busy(update, context, e)
     except Exception as e:
         logger.error("Exception in autocrop: %s", e, exc_info=1)
         return await avatar_error(update, context)
@@ -182,22 +215,44 @@ async def avatar_crop_matrix(update: Update, context):
         id_str = data['id']
         if task.id.hex != id_str:
             return await avatar_error(update, context)
-        if not data.get('uploaded'):
-            # We now rely solely on uploaded image; if missing treat as error
-            logger.error("Matrix-only payload received after client removal of matrix path")
+        matrix = None
+        if 'matrix' in data:
+            # [a,b,c,d,e,f] of the transform selected in the web app, rendered on our side
+            matrix = [float(v) for v in data['matrix']]
+            if len(matrix) != 6 or not all(math.isfinite(v) for v in matrix):
+                raise ValueError(f"bad matrix {data['matrix']}")
+        elif not data.get('uploaded'):
+            logger.error("web_app_data carries neither a matrix nor an uploaded image")
             return await avatar_error(update, context)
     except Exception as e:
         logger.error("Exception parsing web_app_data: %s", e, exc_info=1)
         return await avatar_error(update, context)
     await update.message.reply_text(loc("processing-photo"), reply_markup=ReplyKeyboardRemove())
+    if matrix is not None:
+        if await task.final_from_cache(transform_mode(*matrix)):
+            return await avatar_crop_stage2(task, update, context)
+        try:
+            await task.transform_avatar(*matrix, on_queued=_queue_notifier(update, context))
+        except AdmissionError as e:
+            return await avatar_busy(update, context, e)
+        except Exception as e:
+            logger.error("Exception in transform_avatar: %s", e, exc_info=1)
+            return await avatar_error(update, context)
     return await avatar_crop_stage2(task, update, context)
 
 async def avatar_crop_stage2(task: PhotoTask, update: Update, context: CallbackContext):
     conf: Config = context.application.config
     loc = _localize(update, context)
     try:
-        await task.finalize_avatar()
-        await update.message.reply_document(task.get_final_file(), filename="avatar.jpg")
+        if task.get_final_file() is None:
+            # otherwise it came from the result cache
+            try:
+                await task.finalize_avatar(on_queued=_queue_notifier(update, context))
+            except AdmissionError as e:
+                return await avatar_busy(update, context, e)
+        with metrics.timed("reply_document"):
+            _, ext = os.path.splitext(task.get_final_file())
+            await update.message.reply_document(task.get_final_file(), filename=f"avatar{ext}")
         if conf.photo.cover_path is not None and os.path.isfile(conf.photo.cover_path):
             _, fname = os.path.split(conf.photo.cover_path)
             await update.message.reply_document(
@@ -209,38 +264,21 @@ async def avatar_crop_stage2(task: PhotoTask, update: Update, context: CallbackC
             loc("final-message"),
             reply_markup=ReplyKeyboardRemove()
         )
-        if context.application.base_app.users_collection is not None:
-            try:
-                await context.application.base_app.users_collection.update_one({
-                    "user_id": update.effective_user.id,
-                    "bot_id": context.bot.id,
-                }, {
-                    "$inc": {"avatars_created": 1}
-                })
-            except Exception as ex:
-                logger.error(f"mongodb update error: {ex}", exc_info=1)
+        if _stats(context) is not None:
+            _stats(context).update(update.effective_user.id, context.bot.id, inc={"avatars_created": 1}, upsert=False)
     except Exception as e:
         logger.error("Exception in cropped_st2: %s", e, exc_info=1)
         return await avatar_error(update, context)
     
     task.delete()
+    metrics.conversations.inc("completed")
     return ConversationHandler.END
 
 async def avatar_cancel_inner(update: Update, context: CallbackContext):
     try:
         get_by_user(update.effective_user.id).delete()
-        if context.application.base_app.users_collection is not None:
-            try:
-                await context.application.base_app.users_collection.update_one({
-                    "user_id": update.effective_user.id,
-                    "bot_id": context.bot.id,
-                }, {
-                    "$inc": {
-                        "avatars_cancelled": 1,
-                    }
-                })
-            except Exception as e:
-                logger.error(f"mongodb update error: {e}", exc_info=1)
+        if _stats(context) is not None:
+            _stats(context).update(update.effective_user.id, context.bot.id, inc={"avatars_cancelled": 1}, upsert=False)
         return True
     except KeyError:
         pass
@@ -252,6 +290,7 @@ async def avatar_cancel_inflow(update: Update, context: CallbackContext):
     """Handle the cancel command during the avatar submission."""
     logger.info(f"Avatar submission for {update.effective_user} canceled")
     loc = _localize(update, context)
+    metrics.conversations.inc("cancelled")
     if await avatar_cancel_inner(update, context):
         await update.message.reply_text(
             loc("processing-cancelled"),
@@ -263,6 +302,7 @@ async def avatar_cancel_command(update: Update, context: CallbackContext):
     """Handle the cancel command during the avatar submission."""
     logger.info(f"Avatar submission for {update.effective_user} canceled")
     loc = _localize(update, context)
+    metrics.conversations.inc("cancelled")
     await avatar_cancel_inner(update, context)
     await update.message.reply_text(
     loc("processing-cancelled-message"),
@@ -273,11 +313,8 @@ async def avatar_cancel_command(update: Update, context: CallbackContext):
 async def avatar_autocrop_and_fallback(update: Update, context: CallbackContext):
     """Handle text messages from buttons using locale in case of autocrop."""
     logger.info(f"avatar_autocrop_and_fallback called: {update.effective_user}")
-    loc = _localize(update, context)
 
-    cmd = update.message.text.lower().strip()
-    autocrop_str = loc("autocrop-command").lower().strip()
-    if cmd == autocrop_str:
+    if context.application.base_app.localization.command(update.message.text) == "autocrop-command":
         return await avatar_crop_auto(update, context)
     return await avatar_fallback(update, context)
 
@@ -286,15 +323,15 @@ async def avatar_fallback(update: Update, context: CallbackContext):
     logger.info(f"avatar_fallback called: {update.effective_user}")
     loc = _localize(update, context)
 
-    cmd = update.message.text.lower().strip()
-    cancel_str = loc("cancel-command").lower().strip()
-    if cmd == cancel_str or cmd == "cancel":
+    command = context.application.base_app.localization.command(update.message.text)
+    if command == "cancel-command" or update.message.text.lower().strip() == "cancel":
         return await avatar_cancel_command(update, context)
     
     await update.message.reply_html(loc("unknown-input"))
 
 async def avatar_error(update: Update, context: CallbackContext):
     loc = _localize(update, context)
+    metrics.conversations.inc("error")
     await avatar_cancel_inner(update, context)
     await update.message.reply_text(
     loc("processing-error"),
@@ -302,8 +339,24 @@ async def avatar_error(update: Update, context: CallbackContext):
     )
     return ConversationHandler.END
 
+async def avatar_busy(update: Update, context: CallbackContext, e: AdmissionError):
+    loc = _localize(update, context)
+    logger.warning(f"image job of {update.effective_user.id} not admitted: {e}")
+    if isinstance(e, UserBusy):
+        # the running job answers when done
+        await update.message.reply_text(loc("processing-in-progress"))
+        return None
+    metrics.conversations.inc("busy")
+    await avatar_cancel_inner(update, context)
+    await update.message.reply_text(
+        loc("processing-busy"),
+        reply_markup=ReplyKeyboardRemove()
+    )
+    return ConversationHandler.END
+
 async def avatar_timeout(update: Update, context: CallbackContext):
     loc = _localize(update, context)
+    metrics.conversations.inc("timeout")
     await avatar_cancel_inner(update, context)
     await update.message.reply_text(
     loc("conversation-timeout"),
@@ -331,6 +384,7 @@ async def avatar_debug(update: Update, context: CallbackContext):
         logger.error("Exception in autocrop: %s", e, exc_info=1)
         return await avatar_error(update, context)
     task.debug_code = code
+    task.save()
     await update.message.reply_text("code accepted")
 
 class TGApplication(Application):
@@ -345,10 +399,24 @@ class TGApplication(Application):
 @asynccontextmanager
 async def create_telegram_bot(config: Config, app):
     global web_app_base
-    application = ApplicationBuilder().application_class(TGApplication, kwargs={
+    builder = ApplicationBuilder().application_class(TGApplication, kwargs={
         "base_app": app,
         "base_config": config
-    }).token(token=config.telegram.token.get_secret_value()).build()
+    }).token(token=config.telegram.token.get_secret_value())
+    if config.telegram.mode not in (TELEGRAM_POLLING, TELEGRAM_WEBHOOK):
+        raise ValueError(f"unknown telegram mode {config.telegram.mode}")
+    webhook = config.telegram.mode == TELEGRAM_WEBHOOK
+    if webhook:
+        # updates come from the server's webhook handler through application.update_queue
+        builder = builder.updater(None)
+    # conversation states have to survive restarts together with the tasks they refer to
+    persistent = config.photo.task_store != TASK_STORE_MEMORY
+    if persistent:
+        builder = builder.persistence(PicklePersistence(
+            os.path.join(config.photo.storage_path, config.photo.conversations_file),
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+        ))
+    application = builder.build()
 
     # Conversation handler for /аватар command
     avatar_conversation = ConversationHandler(
@@ -370,7 +438,9 @@ async def create_telegram_bot(config: Config, app):
             CommandHandler("cancel", avatar_cancel_command),
             MessageHandler(filters.TEXT, avatar_fallback)
         ],
-        conversation_timeout=config.photo.conversation_timeout
+        conversation_timeout=config.photo.conversation_timeout,
+        name="avatar",
+        persistent=persistent,
     )
 
     application.add_handler(CommandHandler("start", start))
@@ -381,12 +451,23 @@ async def create_telegram_bot(config: Config, app):
     try:
         await application.initialize()
         await application.start()
-        await application.updater.start_polling()
+        if not webhook:
+            await application.updater.start_polling()
+        elif config.telegram.webhook_register:
+            url = f"{config.server.base}{config.telegram.webhook_path}"
+            await application.bot.set_webhook(
+                url,
+                secret_token=config.telegram.webhook_secret_token(),
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=config.telegram.webhook_max_connections,
+            )
+            logger.info(f"webhook registered at {url}")
 
         app.bot = application
         yield application
     finally:
         app.bot = None
+        if application.updater is not None and application.updater.running:
+            await application.updater.stop()
         await application.stop()
-        await application.updater.stop()
         await application.shutdown()
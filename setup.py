@@ -14,4 +14,8 @@ setup(
         "motor>=3.1",
         "pydantic>=1.10,<2.0",
     ],
+    extras_require={
+        # brotli variants of the web app assets next to the gzip ones
+        "brotli": ["brotli>=1.0"],
+    },
 )
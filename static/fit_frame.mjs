@@ -24,7 +24,7 @@ let offctx = offscreen.getContext('2d');
 // State
 let W=0,H=0,Vmin=0; // viewport
 let frame_size=0,f_left=0,f_top=0; // CSS px
-let pw=0,ph=0; // photo intrinsic
+let pw=0,ph=0; // photo intrinsic, of the original even when a preview is shown
 let transformationMatrix = ETransform; // in real frame units
 const alignment = {x:0,y:0,changed:false,scale:{x:1,y:1}}; // optional realign
 
@@ -48,19 +48,62 @@ function recalcLayout(){
     // resize canvases
     viewer.width = Math.max(1, Math.round(W*DPR)); viewer.height=Math.max(1, Math.round(H*DPR)); viewer.style.width=W+'px'; viewer.style.height=H+'px';
     const sqPx = Math.max(1, Math.round(frame_size*DPR)); offscreen.width=sqPx; offscreen.height=sqPx;
-    draw();
+    draw(); // resizing cleared the canvas
+    updateViewSource();
 }
 
-function initPhoto(){ if(!photoEl.naturalWidth||!photoEl.naturalHeight) return; if(pw===photoEl.naturalWidth && ph===photoEl.naturalHeight) return; pw=photoEl.naturalWidth; ph=photoEl.naturalHeight; const smaller=Math.min(pw,ph); const F = real_frame_size / smaller; transformationMatrix = [[F,0,0],[0,F,0]]; draw(); }
+function initPhoto(){ if(!photoEl.naturalWidth||!photoEl.naturalHeight) return; const w=photo_width||photoEl.naturalWidth, h=photo_height||photoEl.naturalHeight; if(pw===w && ph===h) return; pw=w; ph=h; const smaller=Math.min(pw,ph); const F = real_frame_size / smaller; transformationMatrix = [[F,0,0],[0,F,0]]; scheduleDraw(); }
+
+// Viewer source: the photo decoded once and downscaled for this screen, the full resolution is only drawn by exportData
+const BITMAP_ZOOM = 2; // zooming in up to this far stays sharp
+let viewSource = null, viewSourceKey = '';
+async function updateViewSource(){
+    if(!photoEl.naturalWidth || !frame_size || typeof createImageBitmap!=='function') return;
+    const nw=photoEl.naturalWidth, nh=photoEl.naturalHeight;
+    const k=Math.min(1, Math.round(frame_size*DPR)*BITMAP_ZOOM/Math.min(nw,nh));
+    const w=Math.max(1,Math.round(nw*k)), h=Math.max(1,Math.round(nh*k));
+    const key=`${photoEl.currentSrc}|${w}x${h}`;
+    if(key===viewSourceKey) return;
+    viewSourceKey=key;
+    try {
+        const bitmap=await createImageBitmap(photoEl, {resizeWidth:w, resizeHeight:h, resizeQuality:'high'});
+        if(key!==viewSourceKey){ bitmap.close(); return; } // superseded while decoding
+        if(viewSource) viewSource.close();
+        viewSource=bitmap; scheduleDraw();
+    } catch(err){ console.warn('ImageBitmap failed, drawing the photo element', err); }
+}
 
-function renderToSquare(ctx){const size=ctx.canvas.width; ctx.clearRect(0,0,size,size); ctx.save(); ctx.translate(size/2,size/2); const S = size/real_frame_size; ctx.scale(S,S); const d=decompose(transformationMatrix); ctx.translate(d.translation.x+alignment.x,d.translation.y+alignment.y); ctx.scale(d.scaling.x,d.scaling.y); ctx.rotate(d.rotation); ctx.drawImage(photoEl,-pw/2,-ph/2,pw,ph); ctx.restore(); if(frameSourceEl && frameSourceEl.complete){ ctx.drawImage(frameSourceEl,0,0,size,size); }}
-function draw(){ if(!frame_size) return; renderToSquare(offctx); vctx.clearRect(0,0,viewer.width,viewer.height); const dx=Math.round(f_left*DPR), dy=Math.round(f_top*DPR); vctx.drawImage(offscreen,dx,dy); }
+// Frame times for the debug layer, over the last FRAME_STATS draws
+const FRAME_STATS = 60;
+const frameTimes = {draws:[], intervals:[], requests:0, frames:0, last:0, shown:0};
+const frameTimesEl = document.querySelector('.debug-layer .frame-times');
+function recordFrame(started, finished){
+    const ft=frameTimes; ft.frames++;
+    // gaps between gestures are idle time, not frame time
+    if(ft.last && started-ft.last<250){ ft.intervals.push(started-ft.last); if(ft.intervals.length>FRAME_STATS) ft.intervals.shift(); }
+    ft.last=started;
+    ft.draws.push(finished-started); if(ft.draws.length>FRAME_STATS) ft.draws.shift();
+    if(frameTimesEl && finished-ft.shown>500 && document.body.classList.contains('debug')){ ft.shown=finished; showFrameTimes(); }
+}
+function showFrameTimes(){
+    const ft=frameTimes; const avg=a=>a.length?a.reduce((x,y)=>x+y,0)/a.length:0;
+    const interval=avg(ft.intervals);
+    frameTimesEl.textContent=`draw ${avg(ft.draws).toFixed(1)} ms avg, ${Math.max(0,...ft.draws).toFixed(1)} ms max; `
+        +`frame ${interval.toFixed(1)} ms${interval?` (${(1000/interval).toFixed(0)} fps)`:''}; `
+        +`${(ft.requests/Math.max(1,ft.frames)).toFixed(1)} inputs/frame; source ${viewSource?`bitmap ${viewSource.width}x${viewSource.height}`:'img'}`;
+}
+
+function renderToSquare(ctx,source){const size=ctx.canvas.width; ctx.clearRect(0,0,size,size); ctx.save(); ctx.translate(size/2,size/2); const S = size/real_frame_size; ctx.scale(S,S); const d=decompose(transformationMatrix); ctx.translate(d.translation.x+alignment.x,d.translation.y+alignment.y); ctx.scale(d.scaling.x,d.scaling.y); ctx.rotate(d.rotation); ctx.drawImage(source,-pw/2,-ph/2,pw,ph); ctx.restore(); if(frameSourceEl && frameSourceEl.complete){ ctx.drawImage(frameSourceEl,0,0,size,size); }}
+function draw(){ if(!frame_size) return; const started=performance.now(); renderToSquare(offctx, viewSource||photoEl); vctx.clearRect(0,0,viewer.width,viewer.height); const dx=Math.round(f_left*DPR), dy=Math.round(f_top*DPR); vctx.drawImage(offscreen,dx,dy); recordFrame(started, performance.now()); }
+// Input only updates the transform, the frame is drawn once per display refresh
+let drawPending=false;
+function scheduleDraw(){ frameTimes.requests++; if(drawPending) return; drawPending=true; requestAnimationFrame(()=>{ drawPending=false; draw(); }); }
 
 // Interaction
 let isMouseDown=false,lastX=0,lastY=0; let initialTouchDist=0, initialTouchAngle=0;
-function movePhoto(dx,dy){const [rx,ry]=viewportDeltaToReal(dx,dy); transformationMatrix = M(translate2matrix(rx,ry), transformationMatrix); draw();}
-function rotatePhoto(angle,pivotX_css,pivotY_css){const [px,py]=viewportPointToReal(pivotX_css,pivotY_css); const R = MM(translate2matrix(px,py), rotate2matrix(angle), translate2matrix(-px,-py)); transformationMatrix = M(R, transformationMatrix); draw();}
-function scalePhoto(k,pivotX_css,pivotY_css){const [px,py]=viewportPointToReal(pivotX_css,pivotY_css); const S = MM(translate2matrix(px,py), scale2matrix(k,k), translate2matrix(-px,-py)); transformationMatrix = M(S, transformationMatrix); draw();}
+function movePhoto(dx,dy){const [rx,ry]=viewportDeltaToReal(dx,dy); transformationMatrix = M(translate2matrix(rx,ry), transformationMatrix); scheduleDraw();}
+function rotatePhoto(angle,pivotX_css,pivotY_css){const [px,py]=viewportPointToReal(pivotX_css,pivotY_css); const R = MM(translate2matrix(px,py), rotate2matrix(angle), translate2matrix(-px,-py)); transformationMatrix = M(R, transformationMatrix); scheduleDraw();}
+function scalePhoto(k,pivotX_css,pivotY_css){const [px,py]=viewportPointToReal(pivotX_css,pivotY_css); const S = MM(translate2matrix(px,py), scale2matrix(k,k), translate2matrix(-px,-py)); transformationMatrix = M(S, transformationMatrix); scheduleDraw();}
 
 function onMouseDown(e){e.preventDefault(); isMouseDown=true; lastX=e.clientX; lastY=e.clientY;}
 function onMouseMove(e){ if(!isMouseDown) return; e.preventDefault(); const dx=e.clientX-lastX, dy=e.clientY-lastY; if(e.shiftKey){ const angle=Math.atan2(dy,dx); rotatePhoto(angle,e.clientX,e.clientY);} else { movePhoto(dx,dy); lastX=e.clientX; lastY=e.clientY;} }
@@ -89,26 +132,82 @@ viewer.addEventListener('touchstart', onTouchStart, {passive:false});
 viewer.addEventListener('touchmove', onTouchMove, {passive:false});
 viewer.addEventListener('touchend', onTouchEnd, {passive:false});
 window.addEventListener('resize', ()=>{recalcLayout();});
-photoEl.addEventListener('load', ()=>{initPhoto(); draw();});
+photoEl.addEventListener('load', ()=>{initPhoto(); updateViewSource(); scheduleDraw();});
+// the overlay shows the frame rendition the browser picked for the canvas, no second download
+function frameLoaded(){ overlayEl.style.backgroundImage=`url("${frameSourceEl.currentSrc||frameSourceEl.src}")`; }
+if(frameSourceEl.complete && frameSourceEl.naturalWidth) frameLoaded(); else frameSourceEl.addEventListener('load', frameLoaded);
 
 function exportData(){
-    // Render transformed photo at full resolution (real_frame_size) and upload as binary PNG.
+    if(submission==='matrix') return exportMatrix();
+    return exportUpload();
+}
+
+function exportMatrix(){
+    // Send only the transform, the server renders it from the original photo.
+    const [a,c,e]=transformationMatrix[0]; const [b,d,f]=transformationMatrix[1];
+    Telegram.WebApp.sendData(JSON.stringify({id:photo_id, matrix:[a,b,c,d,e+alignment.x,f+alignment.y]}));
+    Telegram.WebApp.close();
+}
+
+async function loadOriginal(){
+    // the viewer may show a preview, the upload is rendered from the original
+    if(photoEl.naturalWidth===pw && photoEl.naturalHeight===ph) return photoEl;
+    const img=new Image();
+    img.src=photoEl.dataset.src;
+    try { await img.decode(); return img; }
+    catch(err){ console.error('Original photo failed to load', err); return photoEl; }
+}
+
+// upload format name -> [mime type, quality, needs an opaque crop]
+const UPLOAD_TYPES = {
+    'webp': ['image/webp', upload_quality, false],
+    'webp-lossless': ['image/webp', 1, false],
+    'jpeg': ['image/jpeg', upload_quality, true],
+    'png': ['image/png', undefined, false],
+};
+
+function isOpaque(canvas){
+    // JPEG would fill any transparency with black: uncovered corners as well as alpha in the photo itself
+    const data=canvas.getContext('2d').getImageData(0,0,canvas.width,canvas.height).data;
+    for(let i=3;i<data.length;i+=4) if(data[i]!==255) return false;
+    return true;
+}
+
+function toBlob(canvas,type,quality){ return new Promise(resolve=>canvas.toBlob(resolve,type,quality)); }
+
+async function encodeUpload(canvas){
+    // first configured format the browser really encodes, browsers without an encoder silently fall back to PNG
+    const opaque=isOpaque(canvas);
+    for(const name of [...upload_formats, 'png']){
+        const spec=UPLOAD_TYPES[name]; if(!spec) continue;
+        const [type,quality,needsOpaque]=spec;
+        if(needsOpaque && !opaque) continue;
+        const started=performance.now();
+        const blob=await toBlob(canvas,type,quality);
+        if(blob && blob.type===type) return {blob, name, ms:performance.now()-started};
+    }
+    return null;
+}
+
+async function exportUpload(){
+    // Render transformed photo at full resolution (real_frame_size) and upload it in the negotiated format.
+    const source=await loadOriginal();
     const exportCanvas=document.createElement('canvas');
     exportCanvas.width=real_frame_size; exportCanvas.height=real_frame_size;
     const ect=exportCanvas.getContext('2d');
     (function render(){
-        const size=exportCanvas.width; ect.clearRect(0,0,size,size); ect.save(); ect.translate(size/2,size/2); const S=size/real_frame_size; ect.scale(S,S); const d=decompose(transformationMatrix); ect.translate(d.translation.x+alignment.x,d.translation.y+alignment.y); ect.scale(d.scaling.x,d.scaling.y); ect.rotate(d.rotation); ect.drawImage(photoEl,-pw/2,-ph/2,pw,ph); ect.restore(); })();
+        const size=exportCanvas.width; ect.clearRect(0,0,size,size); ect.save(); ect.translate(size/2,size/2); const S=size/real_frame_size; ect.scale(S,S); const d=decompose(transformationMatrix); ect.translate(d.translation.x+alignment.x,d.translation.y+alignment.y); ect.scale(d.scaling.x,d.scaling.y); ect.rotate(d.rotation); ect.drawImage(source,-pw/2,-ph/2,pw,ph); ect.restore(); })();
 
+    const encoded=await encodeUpload(exportCanvas);
+    if(!encoded){ alert('Export failed'); return; }
     const endpoint = new URL('fit_frame', window.location.href); // keeps any subpath prefix
-    endpoint.search = `?id=${encodeURIComponent(photo_id)}`;
-
-    exportCanvas.toBlob(blob=>{
-        if(!blob){ alert('Export failed'); return; }
-        fetch(endpoint.toString(), {method:'POST', headers:{'Content-Type':'image/png'}, body:blob})
-            .then(r=>{ if(!r.ok) throw new Error('upload failed'); return r.json(); })
-            .then(()=>{ Telegram.WebApp.sendData(JSON.stringify({id:photo_id, uploaded:true})); Telegram.WebApp.close(); })
-            .catch(err=>{ console.error('Upload failed', err); alert('Upload failed, please check network and try again.'); });
-    }, 'image/png');
+    // the server sniffs the format from the bytes, format and encode_ms are for its metrics
+    endpoint.search = `?id=${encodeURIComponent(photo_id)}&format=${encoded.name}&encode_ms=${encoded.ms.toFixed(1)}`;
+
+    fetch(endpoint.toString(), {method:'POST', headers:{'Content-Type':encoded.blob.type}, body:encoded.blob})
+        .then(r=>{ if(!r.ok) throw new Error('upload failed'); return r.json(); })
+        .then(()=>{ Telegram.WebApp.sendData(JSON.stringify({id:photo_id, uploaded:true})); Telegram.WebApp.close(); })
+        .catch(err=>{ console.error('Upload failed', err); alert('Upload failed, please check network and try again.'); });
 }
 Telegram.WebApp.MainButton.setText(finish_button_text);
 Telegram.WebApp.MainButton.show();
@@ -116,6 +215,21 @@ Telegram.WebApp.MainButton.onClick(()=>exportData());
 Telegram.WebApp.BackButton.onClick(()=>Telegram.WebApp.close());
 Telegram.WebApp.BackButton.show();
 
+// Preview sized for the on-screen frame, the server rounds it up to one of a few renditions
+const PREVIEW_ZOOM = 1.5; // zooming in up to this far stays sharp
+const PREVIEW_MAX = 2048;
+function previewUrl(){
+    // the photo's short side covers the frame, the rendition is bounded by its long side
+    const frame=Math.min(window.innerWidth, window.innerHeight)*DPR*PREVIEW_ZOOM;
+    const aspect=(photo_width&&photo_height)?Math.max(photo_width,photo_height)/Math.min(photo_width,photo_height):1;
+    const side=Math.min(PREVIEW_MAX, Math.ceil(frame*aspect));
+    const probe=document.createElement('canvas'); probe.width=probe.height=1;
+    const fmt=probe.toDataURL('image/webp').startsWith('data:image/webp')?'webp':'jpeg';
+    return `${photoEl.dataset.src}?max=${side}&fmt=${fmt}`;
+}
+photoEl.addEventListener('error', ()=>{ photoEl.src=photoEl.dataset.src; }, {once:true});
+photoEl.src=previewUrl();
+
 // Init when ready
-function whenReady(){ if(photoEl.complete) {initPhoto(); recalcLayout();} else photoEl.addEventListener('load', ()=>{initPhoto(); recalcLayout();}); if(frameSourceEl && !frameSourceEl.complete) frameSourceEl.addEventListener('load', draw); else draw(); }
+function whenReady(){ if(photoEl.complete) {initPhoto(); recalcLayout();} else photoEl.addEventListener('load', ()=>{initPhoto(); recalcLayout();}); if(frameSourceEl && !frameSourceEl.complete) frameSourceEl.addEventListener('load', scheduleDraw); else scheduleDraw(); }
 whenReady();